@@ -0,0 +1,400 @@
+import asyncio
+import hashlib
+import json
+import math
+import sys
+import threading
+import traceback
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from store import AmbiguousReminder, ReminderNotFound, records_from_input, to_row
+from timeparse import parse_duration, parse_instant
+
+MAX_BODY = 16 << 20
+KEEP_ALIVE_TIMEOUT = 60
+# Recent events kept, serialized, for /events subscribers to read from.
+# One that falls further behind than this gets a reset and skips ahead.
+RING_SIZE = 1 << 16
+# Events written to a subscriber between drains.
+WRITE_BATCH = 256
+# A subscriber that can't get a write out for this many seconds counts as
+# too slow and gets disconnected.
+SUBSCRIBER_TIMEOUT = 10
+HEARTBEAT_INTERVAL = 15
+
+REASONS = {
+    200: 'OK', 201: 'Created', 304: 'Not Modified',
+    400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 409: 'Conflict',
+    500: 'Internal Server Error',
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or REASONS[status])
+        self.status = status
+
+
+class Request:
+    def __init__(self, method, target, headers, body):
+        self.method = method
+        url = urlsplit(target)
+        self.path = [unquote(part) for part in url.path.split('/') if part]
+        self.query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        try:
+            return json.loads(self.body or b'null')
+        except ValueError as e:
+            raise HTTPError(400, f'invalid JSON: {e}') from None
+
+    def float_param(self, name, default=None):
+        value = self.query.get(name)
+        if value is None:
+            return default
+        try:
+            value = float(value)
+        except ValueError:
+            value = math.nan
+        if not math.isfinite(value):
+            raise HTTPError(400, f'{name} must be a number')
+        return value
+
+    def int_param(self, name, default=None):
+        value = self.float_param(name, default)
+        return None if value is None else int(value)
+
+
+class EventStream:
+    # Serializes bus events once, into a ring that every /events subscriber
+    # reads from at its own position. The bus may publish from any thread;
+    # events are handed to the loop in batches and put in the ring there.
+
+    def __init__(self, events, loop, size=RING_SIZE, timeout=SUBSCRIBER_TIMEOUT):
+        self.loop = loop
+        self.size = size
+        self.timeout = timeout
+        self.ring = [None] * size
+        # The last event in the ring, and the first one it ever had.
+        self.seq = events.seq
+        self.first = events.seq + 1
+        self._waiter = loop.create_future()
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._unsubscribe = events.subscribe(self._on_event)
+
+    def close(self):
+        self._unsubscribe()
+
+    def _on_event(self, event):
+        with self._pending_lock:
+            self._pending.append(event)
+            if len(self._pending) > 1:
+                return
+        self.loop.call_soon_threadsafe(self._fanout)
+
+    def _fanout(self):
+        with self._pending_lock:
+            events, self._pending = self._pending, []
+        for event in events:
+            self.ring[event['seq'] % self.size] = (event['kind'], format_event(event))
+        self.seq = events[-1]['seq']
+        waiter, self._waiter = self._waiter, self.loop.create_future()
+        waiter.set_result(None)
+
+    def oldest(self):
+        return max(self.first, self.seq - self.size + 1)
+
+    def read(self, after, limit):
+        # (seq, kind, bytes) of up to `limit` events after `after`, which
+        # has to be no earlier than oldest() - 1.
+        return [(seq, *self.ring[seq % self.size]) for seq in range(after + 1, min(self.seq, after + limit) + 1)]
+
+    async def wait(self, after, timeout):
+        # Whether there is anything after `after` within `timeout` seconds.
+        if self.seq <= after:
+            try:
+                await asyncio.wait_for(asyncio.shield(self._waiter), timeout)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+
+def encode(body):
+    return json.dumps(body).encode()
+
+
+def format_event(event):
+    # Reminder ids as strings, as in to_row.
+    data = dict(event)
+    if 'id' in data:
+        data['id'] = str(data['id'])
+    if 'ids' in data:
+        data['ids'] = [str(key) for key in data['ids']]
+    return f"id: {event['seq']}\nevent: {event['kind']}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+class ReminderAPI:
+    # JSON over HTTP/1.1 with keep-alive, on localhost or a Unix socket:
+    #   GET    /reminders[?since=&until=&offset=&limit=]   (ETag / If-None-Match)
+    #   POST   /reminders              one reminder or a list, one journal batch
+    #   DELETE /reminders              {"ids": [...]}, one journal batch
+    #   GET    /reminders/<ref>
+    #   DELETE /reminders/<ref>
+    #   POST   /reminders/<ref>/snooze   {"seconds": n or "10 min"}
+    #   POST   /reminders/<ref>/reschedule   {"due": unix timestamp or "tomorrow 9am"}
+    #   POST   /reminders/<ref>/ack
+    #   POST   /reminders/<ref>/chain   {"after": <ref>, "on": "fired"|"acked", "delay": "30 min"}
+    # where <ref> is an id or a name only one reminder has (409 otherwise).
+    #   GET    /events[?since=<seq>&kinds=fired,added,...]   server-sent events,
+    #          resumable through ?since or Last-Event-ID
+
+    def __init__(self, store):
+        self.store = store
+        self.stream = None
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), KEEP_ALIVE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    return
+                except HTTPError as e:
+                    # The rest of what was sent can't be made sense of.
+                    await self._write_response(writer, e.status, {}, encode({'error': str(e)}), False)
+                    return
+                if request is None:
+                    return
+                if request.path == ['events'] and request.method == 'GET' and self.stream is not None:
+                    await self.stream_events(request, writer)
+                    return
+                # Handlers wait on the store's locks and fsync; only socket
+                # I/O stays on the loop.
+                status, headers, payload = await asyncio.to_thread(self.respond, request)
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                await self._write_response(writer, status, headers, payload, keep_alive)
+                if not keep_alive:
+                    return
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, _ = line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            raise ConnectionError('malformed request line') from None
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length', 0) or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise HTTPError(400, 'bad Content-Length')
+        if length > MAX_BODY:
+            raise ConnectionError('request body too large')
+        body = await reader.readexactly(length) if length else b''
+        return Request(method.upper(), target, headers, body)
+
+    async def _write_response(self, writer, status, headers, payload, keep_alive):
+        # `payload` is encoded JSON, or None for no body.
+        lines = [f'HTTP/1.1 {status} {REASONS.get(status, "")}']
+        headers = dict(headers)
+        if payload is not None:
+            headers['Content-Type'] = 'application/json'
+        else:
+            payload = b''
+        headers['Content-Length'] = str(len(payload))
+        headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        lines += [f'{key}: {value}' for key, value in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + payload)
+        await writer.drain()
+
+    def respond(self, request):
+        # (status, headers, encoded body) for a request; runs off the loop.
+        try:
+            status, headers, body = self.dispatch(request)
+        except HTTPError as e:
+            status, headers, body = e.status, {}, {'error': str(e)}
+        except ReminderNotFound as e:
+            status, headers, body = 404, {}, {'error': f'no such reminder: {e.args[0]}'}
+        except AmbiguousReminder as e:
+            status, headers, body = 409, {}, {'error': f'several reminders are called {e.name!r}',
+                                              'ids': [str(key) for key in e.ids]}
+        except ValueError as e:
+            status, headers, body = 400, {}, {'error': str(e)}
+        except Exception as e:
+            print(f'{request.method} /{"/".join(request.path)} failed:', file=sys.stderr)
+            traceback.print_exc()
+            status, headers, body = 500, {}, {'error': f'{type(e).__name__}: {e}'}
+        return status, headers, None if body is None else encode(body)
+
+    def dispatch(self, request):
+        path, method = request.path, request.method
+        if not path or path[0] != 'reminders' or len(path) > 3:
+            raise HTTPError(404)
+        if len(path) == 1:
+            handlers = {'GET': self.list, 'POST': self.create, 'DELETE': self.delete_many}
+        elif len(path) == 2:
+            handlers = {'GET': self.get, 'DELETE': self.delete}
+        elif path[2] == 'snooze':
+            handlers = {'POST': self.snooze}
+        elif path[2] == 'reschedule':
+            handlers = {'POST': self.reschedule}
+        elif path[2] == 'ack':
+            handlers = {'POST': self.ack}
+        elif path[2] == 'chain':
+            handlers = {'POST': self.chain}
+        else:
+            raise HTTPError(404)
+        if method not in handlers:
+            raise HTTPError(405)
+        return handlers[method](request)
+
+    def list(self, request):
+        since, until = request.float_param('since'), request.float_param('until')
+        offset, limit = request.int_param('offset', 0), request.int_param('limit')
+        if offset < 0 or (limit is not None and limit < 0):
+            raise HTTPError(400, 'offset and limit cannot be negative')
+        store = self.store
+        with store.lock:
+            store.refresh()
+            # The store revision changes on every committed batch, so it and
+            # the query together identify the response.
+            key = f'{store.generation}:{store.snapshot_stamp}:{store.revision}:{since}:{until}:{offset}:{limit}'
+            etag = '"%s"' % hashlib.sha1(key.encode()).hexdigest()[:20]
+            if etag in request.headers.get('if-none-match', ''):
+                return 304, {'ETag': etag}, None
+            rows = [to_row(key, record) for key, record in store.iter_due(since, until, offset, limit)]
+        return 200, {'ETag': etag}, rows
+
+    def get(self, request):
+        with self.store.lock:
+            key = self.store.resolve(request.path[1])
+            return 200, {}, to_row(key, self.store.get(key))
+
+    def create(self, request):
+        data = request.json()
+        items = data if isinstance(data, list) else [data]
+        if not all(isinstance(item, dict) for item in items):
+            raise HTTPError(400, 'expected a reminder object or a list of them')
+        # Parsed before taking the lock, which a bulk request would hold
+        # for long; only "after" (which may name the reminder to wait for
+        # instead of its id) needs the store.
+        chained = [i for i, item in enumerate(items) if isinstance(item.get('after'), dict) and 'id' in item['after']]
+        if chained:
+            items = list(items)
+            with self.store.lock:
+                for i in chained:
+                    after = items[i]['after']
+                    items[i] = dict(items[i], after=dict(after, id=self.store.resolve(after['id'])))
+        records = records_from_input(items)
+        rows = [to_row(key, record) for key, record in self.store.add_many(records)]
+        return 201, {}, rows if isinstance(data, list) else rows[0]
+
+    def delete(self, request):
+        with self.store.lock:
+            key, record = self.store.remove(self.store.resolve(request.path[1]))
+        return 200, {}, to_row(key, record)
+
+    def delete_many(self, request):
+        data = request.json()
+        refs = (data.get('ids') or data.get('names')) if isinstance(data, dict) else data
+        if not isinstance(refs, list):
+            raise HTTPError(400, 'expected {"ids": [...]}')
+        with self.store.lock:
+            removed = self.store.remove_many(self.store.resolve_many(refs))
+        return 200, {}, [to_row(key, record) for key, record in removed]
+
+    def snooze(self, request):
+        data = request.json()
+        if not isinstance(data, dict) or 'seconds' not in data:
+            raise HTTPError(400, 'expected {"seconds": n or "10 min"}')
+        with self.store.lock:
+            key = self.store.resolve(request.path[1])
+            record = self.store.snooze(key, parse_duration(data['seconds']))
+        return 200, {}, to_row(key, record)
+
+    def reschedule(self, request):
+        data = request.json()
+        if not isinstance(data, dict) or 'due' not in data:
+            raise HTTPError(400, 'expected {"due": unix timestamp}')
+        with self.store.lock:
+            key = self.store.resolve(request.path[1])
+            record = self.store.reschedule(key, parse_instant(data['due']))
+        return 200, {}, to_row(key, record)
+
+    def ack(self, request):
+        with self.store.lock:
+            key, record = self.store.ack(self.store.resolve(request.path[1]))
+        return 200, {}, to_row(key, record)
+
+    def chain(self, request):
+        data = request.json()
+        if not isinstance(data, dict) or 'after' not in data:
+            raise HTTPError(400, 'expected {"after": <id or name>}')
+        with self.store.lock:
+            key = self.store.resolve(request.path[1])
+            after = {'id': self.store.resolve(data['after']), 'on': data.get('on', 'fired'),
+                     'delay': data.get('delay', 0)}
+            record = self.store.chain(key, after)
+        return 200, {}, to_row(key, record)
+
+    async def stream_events(self, request, writer):
+        try:
+            since = int(request.query.get('since') or request.headers.get('last-event-id') or 0)
+        except ValueError:
+            since = 0
+        kinds = set(request.query['kinds'].split(',')) if request.query.get('kinds') else None
+        stream = self.stream
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+                     b'Cache-Control: no-cache\r\nConnection: keep-alive\r\n\r\n')
+        last_seq = since or stream.seq
+        try:
+            while True:
+                if not stream.oldest() - 1 <= last_seq <= stream.seq:
+                    # What comes next is no longer kept (or, from before a
+                    # restart, never was): skip to what is, with its id to
+                    # resume from.
+                    last_seq = stream.oldest() - 1
+                    writer.write(f'id: {last_seq}\nevent: reset\ndata: {{}}\n\n'.encode())
+                events = stream.read(last_seq, WRITE_BATCH)
+                if events:
+                    writer.write(b''.join(data for _, kind, data in events if kinds is None or kind in kinds))
+                    last_seq = events[-1][0]
+                elif not await stream.wait(last_seq, HEARTBEAT_INTERVAL):
+                    writer.write(b': keepalive\n\n')
+                await self._drain(writer)
+        except ConnectionError:
+            pass
+
+    async def _drain(self, writer):
+        # A client that doesn't read holds the write buffer full; it is
+        # dropped rather than waited for.
+        try:
+            await asyncio.wait_for(writer.drain(), self.stream.timeout)
+        except asyncio.TimeoutError:
+            writer.transport.abort()
+            raise ConnectionError('subscriber stopped reading') from None
+
+
+async def serve(api, host='127.0.0.1', port=8765, socket_path=None):
+    if api.store.events is not None:
+        api.stream = EventStream(api.store.events, asyncio.get_running_loop())
+    if socket_path:
+        server = await asyncio.start_unix_server(api.handle_connection, path=socket_path)
+    else:
+        server = await asyncio.start_server(api.handle_connection, host, port)
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,253 @@
+import collections
+import collections.abc
+import json
+import mmap
+import operator
+import os
+import struct
+from array import array
+
+# A fixed-record index over a snapshot written by ReminderStore._compact.
+# The snapshot itself is the string heap: every record's JSON sits at a
+# known offset in it, so a warm start maps both files and only decodes a
+# record when something asks for it.
+#
+#   header   MAGIC, count, lookup offset, snapshot (inode, mtime_ns, size)
+#   records  (id, due, flags, heap offset, length), in due order
+#   lookup   (id, record slot), in id order
+MAGIC = b'RIX2'
+HEADER = struct.Struct('<4sIQQqq')
+RECORD = struct.Struct('<qdIQI')
+LOOKUP = struct.Struct('<qQ')
+# Decoded records kept around; the rest are decoded again when read.
+COLD_CACHE_SIZE = 10000
+
+
+def write_index(path, heap_stamp, keys, dues, flags, offsets, lengths):
+    # Columns as parallel arrays, in any order; written to a sibling file
+    # and renamed into place.
+    count = len(keys)
+    # By due and, among the same due, by id: the order DueIndex merges in.
+    by_due = sorted(range(count), key=keys.__getitem__)
+    by_due.sort(key=dues.__getitem__)
+    records = bytearray(count * RECORD.size)
+    slots = array('Q', bytes(8 * count))
+    for slot, i in enumerate(by_due):
+        RECORD.pack_into(records, slot * RECORD.size, keys[i], dues[i], flags[i], offsets[i], lengths[i])
+        slots[i] = slot
+    lookup = bytearray(count * LOOKUP.size)
+    for n, i in enumerate(sorted(range(count), key=keys.__getitem__)):
+        LOOKUP.pack_into(lookup, n * LOOKUP.size, keys[i], slots[i])
+    ino, mtime_ns, size = heap_stamp
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, count, HEADER.size + len(records), ino, mtime_ns, size))
+        f.write(records)
+        f.write(lookup)
+    os.replace(tmp_path, path)
+
+
+class BinaryIndex:
+    # Read-only view of an index file and the snapshot it was written for,
+    # both memory-mapped. The fixed records are the hot part and are copied
+    # into memory; the snapshot (names, descriptions, everything else) is
+    # left to be paged in as records are decoded.
+
+    def __init__(self, index, heap):
+        self._index_map, self._heap_map = index, heap
+        self.buf = memoryview(index)
+        self.heap = memoryview(heap)
+        _, self.count, self.lookup_offset, _, _, _ = HEADER.unpack_from(self.buf)
+        self.records = memoryview(self.buf[HEADER.size:HEADER.size + self.count * RECORD.size].tobytes())
+
+    @classmethod
+    def open(cls, path, heap_path, heap_stamp):
+        # The index for the snapshot at heap_path, or None when there is
+        # none or it was written for another snapshot.
+        try:
+            with open(path, 'rb') as f, open(heap_path, 'rb') as heap_file:
+                st = os.fstat(heap_file.fileno())
+                if [st.st_ino, st.st_mtime_ns, st.st_size] != list(heap_stamp):
+                    return None
+                if os.fstat(f.fileno()).st_size < HEADER.size or not st.st_size:
+                    return None
+                index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                magic, _, _, ino, mtime_ns, size = HEADER.unpack_from(index)
+                if magic != MAGIC or [ino, mtime_ns, size] != list(heap_stamp):
+                    return None
+                heap = mmap.mmap(heap_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+        return cls(index, heap)
+
+    def __len__(self):
+        return self.count
+
+    def find(self, key):
+        # Slot of `key`, or None: a binary search over the lookup section.
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found, slot = LOOKUP.unpack_from(self.buf, self.lookup_offset + mid * LOOKUP.size)
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return slot
+        return None
+
+    def max_key(self):
+        if not self.count:
+            return 0
+        return LOOKUP.unpack_from(self.buf, self.lookup_offset + (self.count - 1) * LOOKUP.size)[0]
+
+    def hot(self):
+        # (id, due, flags) in due order, without touching the heap.
+        return map(operator.itemgetter(0, 1, 2), RECORD.iter_unpack(self.records))
+
+    def due_at(self, slot):
+        key, due = RECORD.unpack_from(self.records, slot * RECORD.size)[:2]
+        return due, key
+
+    def due_slot(self, due):
+        # First slot due at or after `due`.
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if RECORD.unpack_from(self.records, mid * RECORD.size)[1] < due:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def dues(self, slot=0):
+        # (due, id) from `slot` on, in due order.
+        return map(operator.itemgetter(1, 0), RECORD.iter_unpack(self.records[slot * RECORD.size:]))
+
+    def hot_entry(self, slot):
+        return RECORD.unpack_from(self.records, slot * RECORD.size)[1:3]
+
+    def raw(self, slot):
+        _, _, _, offset, length = RECORD.unpack_from(self.records, slot * RECORD.size)
+        return self.heap[offset:offset + length]
+
+    def entry(self, slot):
+        # (id, due, flags, raw JSON) of one slot.
+        key, due, flags, offset, length = RECORD.unpack_from(self.records, slot * RECORD.size)
+        return key, due, flags, self.heap[offset:offset + length]
+
+    def record(self, slot):
+        return json.loads(bytes(self.raw(slot)))
+
+
+class LazyRecords(collections.abc.MutableMapping):
+    # id -> record, reading from a BinaryIndex (if any) on demand, with
+    # everything put or deleted since the index was written kept on top.
+    # Records read from the index stay decoded in an LRU of `cache_size`.
+    # `flags` gives a record's flags for the index and hot().
+
+    def __init__(self, index, flags, cache_size=COLD_CACHE_SIZE):
+        self.index = index
+        self.flags = flags
+        self.changed = {}
+        self.removed = set()
+        self.loaded = collections.OrderedDict()
+        self.cache_size = cache_size
+        self._len = len(index) if index is not None else 0
+
+    def _slot(self, key):
+        if self.index is None or key in self.removed:
+            return None
+        return self.index.find(key)
+
+    def __getitem__(self, key):
+        record = self.changed.get(key)
+        if record is not None:
+            return record
+        record = self.loaded.get(key)
+        if record is not None:
+            self.loaded.move_to_end(key)
+            return record
+        slot = self._slot(key)
+        if slot is None:
+            raise KeyError(key)
+        record = self.loaded[key] = self.index.record(slot)
+        if len(self.loaded) > self.cache_size:
+            self.loaded.popitem(last=False)
+        return record
+
+    def hot_entry(self, key):
+        # (due, flags) without decoding the record.
+        record = self.changed.get(key)
+        if record is not None:
+            return record['due'], self.flags(record)
+        slot = self._slot(key)
+        if slot is None:
+            raise KeyError(key)
+        return self.index.hot_entry(slot)
+
+    def __contains__(self, key):
+        return key in self.changed or key in self.loaded or self._slot(key) is not None
+
+    def __setitem__(self, key, record):
+        if key not in self:
+            self._len += 1
+        self.loaded.pop(key, None)
+        self.changed[key] = record
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._len -= 1
+        self.changed.pop(key, None)
+        self.loaded.pop(key, None)
+        if self.index is not None and self.index.find(key) is not None:
+            self.removed.add(key)
+
+    def __len__(self):
+        return self._len
+
+    def _shadowed(self, key):
+        return key in self.changed or key in self.removed
+
+    def __iter__(self):
+        if self.index is not None:
+            for key, _, _ in self.index.hot():
+                if not self._shadowed(key):
+                    yield key
+        yield from list(self.changed)
+
+    def max_key(self):
+        found = max(self.changed, default=0)
+        if self.index is not None:
+            # The largest id may have been removed since; rare, so look.
+            top = self.index.max_key()
+            found = max(found, top if top not in self.removed else max(self, default=0))
+        return found
+
+    def hot(self):
+        # (id, due, flags) of every record, without decoding the ones that
+        # are only in the index.
+        if self.index is not None and not self.changed and not self.removed:
+            return self.index.hot()
+        return self._merged_hot()
+
+    def _merged_hot(self):
+        if self.index is not None:
+            for key, due, flags in self.index.hot():
+                if not self._shadowed(key):
+                    yield key, due, flags
+        for key, record in list(self.changed.items()):
+            yield key, record['due'], self.flags(record)
+
+    def raw_items(self):
+        # (id, due, flags, JSON bytes) of every record, copying index
+        # records as they are.
+        if self.index is not None:
+            for slot in range(len(self.index)):
+                entry = self.index.entry(slot)
+                if not self._shadowed(entry[0]):
+                    yield entry
+        for key, record in list(self.changed.items()):
+            yield key, record['due'], self.flags(record), json.dumps(record).encode()
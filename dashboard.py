@@ -0,0 +1,275 @@
+import json
+import os
+import queue
+import select
+import socket
+import sys
+import termios
+import threading
+import time
+import tty
+from bisect import insort
+from collections import deque
+
+from preview import format_time
+from term import terminal_size
+
+REFRESH_INTERVAL = 0.1
+# Seconds between attempts to reach the daemon's event stream.
+RECONNECT_INTERVAL = 5
+# The daemon sends a keepalive every 15 seconds; this long without one and
+# the connection is given up on.
+STREAM_TIMEOUT = 40
+DELIVERY_KINDS = ('fired', 'digest', 'failed')
+# Store events that change what is scheduled: a put carries the due time,
+# name and description the reminder has now, a removal only its id.
+STORE_KINDS = ('added', 'removed', 'snoozed', 'rescheduled', 'triggered', 'chained', 'acked', 'unacked',
+               'followed_up')
+
+
+def format_countdown(seconds):
+    sign = '-' if seconds < 0 else ''
+    seconds = int(abs(seconds))
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    clock = f'{hours:02d}:{minutes:02d}:{seconds:02d}'
+    return f'{sign}{days}d {clock}' if days else sign + clock
+
+
+class ScreenBuffer:
+    # Double-buffered text screen: `front` is what the terminal shows, each
+    # frame is diffed against it and only the changed runs of cells are
+    # written.
+
+    # Unchanged gaps shorter than this are rewritten rather than skipped,
+    # since a cursor move costs about as many bytes.
+    MERGE_GAP = 6
+
+    def __init__(self, out):
+        self.out = out
+        self.front = None
+
+    def invalidate(self):
+        self.front = None
+
+    def draw(self, lines):
+        cols, rows = terminal_size()
+        back = [line[:cols].ljust(cols) for line in lines[:rows]]
+        back += [' ' * cols] * (rows - len(back))
+        if self.front is None or len(self.front) != rows or len(self.front[0]) != cols:
+            self.out.write('\x1b[H\x1b[2J' + '\r\n'.join(back))
+        else:
+            self.out.write(''.join(self._diff(self.front, back)))
+        self.out.flush()
+        self.front = back
+
+    def _diff(self, front, back):
+        for y, (old, new) in enumerate(zip(front, back)):
+            if old == new:
+                continue
+            x, end = 0, len(new)
+            while x < end:
+                if old[x] == new[x]:
+                    x += 1
+                    continue
+                start = x
+                same = 0
+                while x < end and same < self.MERGE_GAP:
+                    same = same + 1 if old[x] == new[x] else 0
+                    x += 1
+                stop = x - same
+                yield f'\x1b[{y + 1};{start + 1}H{new[start:stop]}'
+
+
+class EventFollower:
+    # Reads the /events stream of a `serve` daemon on a thread and hands
+    # each event to `callback`, reconnecting (from the last event seen)
+    # whenever the connection drops. A `reset` event is passed on when
+    # events were missed: the stream skipped some, or there was no last
+    # event to resume from.
+
+    def __init__(self, callback, host='127.0.0.1', port=8765, socket_path=None, kinds=DELIVERY_KINDS + STORE_KINDS):
+        self.callback = callback
+        self.host, self.port, self.socket_path = host, port, socket_path
+        self.kinds = kinds
+        self.connected = False
+        self.last_seq = 0
+        self._sock = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='dashboard-events', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _connect(self):
+        if self.socket_path:
+            sock = socket.socket(socket.AF_UNIX)
+            sock.settimeout(STREAM_TIMEOUT)
+            sock.connect(self.socket_path)
+            return sock
+        return socket.create_connection((self.host, self.port), STREAM_TIMEOUT)
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self._sock = self._connect()
+                with self._sock:
+                    self._follow(self._sock)
+            except (OSError, ValueError):
+                pass
+            self.connected = False
+            self._stopped.wait(RECONNECT_INTERVAL)
+
+    def _follow(self, sock):
+        sock.sendall(f"GET /events?since={self.last_seq}&kinds={','.join(self.kinds)} HTTP/1.1\r\n"
+                     f"Host: {self.host}\r\nAccept: text/event-stream\r\n\r\n".encode('latin-1'))
+        lines = sock.makefile('rb')
+        status = lines.readline().split()
+        if len(status) < 2 or status[1] != b'200':
+            raise ValueError('the daemon has no event stream')
+        while lines.readline() not in (b'\r\n', b'\n', b''):
+            pass
+        self.connected = True
+        if not self.last_seq:
+            self.callback({'kind': 'reset'})
+        kind = None
+        for line in lines:
+            line = line.rstrip(b'\r\n')
+            if line.startswith(b'id: '):
+                # A reset has one too, for where the stream picks up.
+                self.last_seq = int(line[4:])
+            elif line.startswith(b'event: '):
+                kind = line[7:].decode()
+            elif line.startswith(b'data: '):
+                self.callback(json.loads(line[6:]) if kind != 'reset' else {'kind': 'reset'})
+            elif not line:
+                kind = None
+
+
+class Dashboard:
+    # Read-only: it never delivers anything itself. The store is read once
+    # at startup and again after a reset of the daemon's event stream (see
+    # EventFollower); in between, the store events on that stream keep the
+    # pending count and the first reminders due up to date, deliveries and
+    # failures come from it too, and countdowns are recomputed every frame.
+
+    def __init__(self, store, daemon, count=10, history=10):
+        self.store = store
+        self.count = count
+        self.fired = deque(maxlen=history)
+        self.failed = deque(maxlen=history)
+        # (due, id, name, description) of the first `window` reminders due,
+        # `complete` when there are no more than those. Ones moved out of
+        # it are only replaced by reading the store again, so it holds more
+        # than are shown.
+        self.window = count * 2
+        self.upcoming = []
+        self.complete = True
+        self.pending = 0
+        # Ids added or removed since the store was read.
+        self._present = {}
+        self._inbox = queue.SimpleQueue()
+        # (host, port, socket path) of the daemon.
+        self.follower = EventFollower(self._inbox.put, *daemon)
+        self._read_store()
+
+    def close(self):
+        self.follower.stop()
+
+    def _read_store(self):
+        with self.store.lock:
+            self.store.refresh()
+            self.pending = len(self.store)
+            self.upcoming = [(record['due'], key, record['name'], record['description'])
+                             for key, record in self.store.next_due(self.window)]
+        self.complete = len(self.upcoming) < self.window
+        self._present = {}
+
+    def _schedule(self, key, entry):
+        # `entry` is what `key` is now, or None if it was removed.
+        present = entry is not None
+        if present != self._present.pop(key, key in self.store):
+            self.pending += 1 if present else -1
+        if present != (key in self.store):
+            self._present[key] = present
+        self.upcoming = [item for item in self.upcoming if item[1] != key]
+        # Past the last one held, the reminders in between are unknown.
+        if present and (self.complete or (self.upcoming and entry < self.upcoming[-1])):
+            insort(self.upcoming, entry)
+            if len(self.upcoming) > self.window:
+                self.upcoming.pop()
+                self.complete = False
+
+    def _apply_events(self):
+        while True:
+            try:
+                event = self._inbox.get_nowait()
+            except queue.Empty:
+                break
+            kind = event['kind']
+            if kind == 'reset':
+                self._read_store()
+            elif kind in STORE_KINDS:
+                key = int(event['id'])
+                self._schedule(key, (event['due'], key, event['name'], event['description'])
+                               if 'due' in event else None)
+            elif kind in ('fired', 'digest'):
+                self.fired.appendleft(event)
+            elif kind == 'failed':
+                self.failed.appendleft(event)
+        if not self.complete and len(self.upcoming) < self.count:
+            self._read_store()
+
+    def lines(self, now):
+        self._apply_events()
+        lines = [f'Reminders: {self.pending} pending'.ljust(60) + format_time(now), '', 'Next']
+        for due, _, name, description in self.upcoming[:self.count]:
+            lines.append(f"  {format_countdown(due - now):>14}  {name}  {description}")
+        if not self.upcoming:
+            lines.append('  (nothing scheduled)')
+        lines += ['', 'Recently fired' if self.follower.connected
+                  else 'Recently fired (daemon not reachable)']
+        lines += [f"  {format_time(event['time'])}  {event['name']}" for event in self.fired] or ['  -']
+        lines += ['', 'Delivery failures']
+        lines += [f"  {format_time(event['time'])}  {event['name']}  {event['error']}" for event in self.failed] or ['  -']
+        lines += ['', 'q to quit']
+        return lines
+
+    def run(self, out=sys.stdout, stdin=sys.stdin):
+        screen = ScreenBuffer(out)
+        fd = stdin.fileno()
+        old = termios.tcgetattr(fd)
+        try:
+            tty.setcbreak(fd)
+            self.follower.start()
+            out.write('\x1b[?1049h\x1b[?25l')
+            next_frame = time.monotonic()
+            while True:
+                screen.draw(self.lines(time.time()))
+                next_frame += REFRESH_INTERVAL
+                timeout = next_frame - time.monotonic()
+                if timeout < 0:
+                    # Fell behind; don't try to catch up with a burst of frames.
+                    next_frame, timeout = time.monotonic(), 0
+                if select.select([fd], [], [], timeout)[0]:
+                    key = os.read(fd, 32)
+                    if key in (b'q', b'Q', b'\x1b'):
+                        return
+                    if key == b'\x0c':
+                        screen.invalidate()
+        finally:
+            out.write('\x1b[?25h\x1b[?1049l')
+            out.flush()
+            termios.tcsetattr(fd, termios.TCSADRAIN, old)
+            self.close()
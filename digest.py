@@ -0,0 +1,36 @@
+import functools
+import string
+
+from preview import format_time
+
+ROW_TEMPLATE = '{time}  {name}: {description}'
+ROW_FIELDS = ('id', 'time', 'name', 'description', 'user')
+
+
+@functools.lru_cache(maxsize=64)
+def compile_template(template):
+    # Splits a row template into (literal, field, spec) parts once, so a
+    # digest of many rows doesn't parse the format string for every row.
+    parts = []
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        if field is not None and field not in ROW_FIELDS:
+            raise ValueError(f'unknown field {field!r} in digest template, use one of {", ".join(ROW_FIELDS)}')
+        if conversion:
+            raise ValueError(f'conversions are not supported in digest templates: {template!r}')
+        parts.append((literal, field, spec or ''))
+    return tuple(parts)
+
+
+def render_row(parts, key, record):
+    values = {'id': key, 'time': format_time(record['due'], record.get('tz')), 'name': record['name'],
+              'description': record['description'], 'user': record.get('user') or ''}
+    return ''.join(literal + ('' if field is None else format(values[field], spec)) for literal, field, spec in parts)
+
+
+def render_digest(title, rows, template=None):
+    # (title, message) for one notification covering all `rows`, given as
+    # (id, record) pairs in due order.
+    parts = compile_template(template or ROW_TEMPLATE)
+    count = len(rows)
+    title = f"{title}: {count} reminder{'' if count == 1 else 's'}"
+    return title, '\n'.join(render_row(parts, key, record) for key, record in rows)
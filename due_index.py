@@ -0,0 +1,180 @@
+import heapq
+import itertools
+from bisect import bisect_left, insort
+
+# Sorted (due, key) pairs kept in chunks of at most CHUNK_SIZE entries, so an
+# insert or delete only shifts one small list instead of the whole index.
+CHUNK_SIZE = 1024
+
+
+class DueIndex:
+    # (due, key) of every reminder in due order: the records of a
+    # BinaryIndex (`base`, in that order already and only read where a
+    # query lands), less the ones hidden since, merged with the chunks of
+    # everything added since.
+
+    def __init__(self, base=None):
+        self.reset(base)
+
+    def reset(self, base):
+        self.base = base
+        self._due = {}
+        self._chunks = []
+        self._maxes = []
+        # Slots of base records removed or replaced since, sorted.
+        self._hidden = []
+
+    def __len__(self):
+        return len(self._due) + (len(self.base) - len(self._hidden) if self.base is not None else 0)
+
+    def _base_slot(self, key):
+        # Slot of `key` in the base, if it is there and not hidden.
+        slot = self.base.find(key) if self.base is not None else None
+        if slot is None:
+            return None
+        i = bisect_left(self._hidden, slot)
+        return None if i < len(self._hidden) and self._hidden[i] == slot else slot
+
+    def __contains__(self, key):
+        return key in self._due or self._base_slot(key) is not None
+
+    def due(self, key):
+        if key in self._due:
+            return self._due[key]
+        slot = self._base_slot(key)
+        if slot is None:
+            raise KeyError(key)
+        return self.base.due_at(slot)[0]
+
+    def _hide(self, key):
+        slot = self._base_slot(key)
+        if slot is None:
+            return False
+        insort(self._hidden, slot)
+        return True
+
+    def add(self, key, due):
+        if key in self._due:
+            self._remove_added(key)
+        else:
+            self._hide(key)
+        entry = (due, key)
+        self._due[key] = due
+        if not self._chunks:
+            self._chunks.append([entry])
+            self._maxes.append(entry)
+            return
+        i = min(bisect_left(self._maxes, entry), len(self._chunks) - 1)
+        chunk = self._chunks[i]
+        insort(chunk, entry)
+        self._maxes[i] = chunk[-1]
+        if len(chunk) > 2 * CHUNK_SIZE:
+            self._chunks[i:i + 1] = [chunk[:CHUNK_SIZE], chunk[CHUNK_SIZE:]]
+            self._maxes[i:i + 1] = [chunk[CHUNK_SIZE - 1], chunk[-1]]
+
+    def remove(self, key):
+        if key in self._due:
+            self._remove_added(key)
+        elif not self._hide(key):
+            raise KeyError(key)
+
+    def _remove_added(self, key):
+        due = self._due.pop(key)
+        entry = (due, key)
+        i = bisect_left(self._maxes, entry)
+        chunk = self._chunks[i]
+        del chunk[bisect_left(chunk, entry)]
+        if chunk:
+            self._maxes[i] = chunk[-1]
+        else:
+            del self._chunks[i]
+            del self._maxes[i]
+
+    def move(self, key, due):
+        self.remove(key)
+        self.add(key, due)
+
+    def range(self, since=None, until=None, offset=0, limit=None):
+        # Yields (due, key) for since <= due <= until in due order.
+        for entry in self._iter_from(since, offset):
+            if until is not None and entry[0] > until:
+                return
+            if limit is not None:
+                if limit <= 0:
+                    return
+                limit -= 1
+            yield entry
+
+    def _rank(self, entry):
+        # How many added entries sort before `entry`.
+        i = bisect_left(self._maxes, entry)
+        if i >= len(self._chunks):
+            return len(self._due)
+        return sum(map(len, self._chunks[:i])) + bisect_left(self._chunks[i], entry)
+
+    def _added_from(self, since, offset):
+        i = 0 if since is None else bisect_left(self._maxes, (since,))
+        if i >= len(self._chunks):
+            return
+        chunk = self._chunks[i]
+        j = 0 if since is None else bisect_left(chunk, (since,))
+        while offset:
+            remaining = len(chunk) - j
+            if offset < remaining:
+                j += offset
+                break
+            offset -= remaining
+            i, j = i + 1, 0
+            if i >= len(self._chunks):
+                return
+            chunk = self._chunks[i]
+        for chunk in self._chunks[i:]:
+            yield from chunk[j:]
+            j = 0
+
+    def _base_from(self, slot):
+        h = bisect_left(self._hidden, slot)
+        for slot, entry in enumerate(self.base.dues(slot), slot):
+            if h < len(self._hidden) and self._hidden[h] == slot:
+                h += 1
+                continue
+            yield entry
+
+    def _seek(self, since, offset):
+        # (base slot, added rank, entries left to skip) to start merging
+        # from for the `offset`th entry from `since` on. The base slot is
+        # found by a binary search over how many entries sort before each.
+        first = 0 if since is None else self.base.due_slot(since)
+        start = 0 if since is None else self._rank((since,))
+
+        def before(slot):
+            hidden = bisect_left(self._hidden, slot) - bisect_left(self._hidden, first)
+            return slot - first - hidden + self._rank(self.base.due_at(slot)) - start
+
+        if first == len(self.base) or before(first) > offset:
+            return first, start + offset, 0
+        lo, hi = first, len(self.base) - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if before(mid) <= offset:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo, self._rank(self.base.due_at(lo)), offset - before(lo)
+
+    def _iter_from(self, since, offset):
+        if self.base is None:
+            yield from self._added_from(since, offset)
+            return
+        slot, rank, skip = self._seek(since, offset)
+        merged = heapq.merge(self._base_from(slot), self._added_from(None, rank))
+        yield from itertools.islice(merged, skip, None)
+
+    def next_due(self, k=1, after=None):
+        return list(self.range(since=after, limit=k))
+
+    def first(self):
+        return next(self._iter_from(None, 0), None)
+
+    def count(self, since=None, until=None):
+        return sum(1 for _ in self.range(since, until))
@@ -0,0 +1,39 @@
+import threading
+import time
+from collections import deque
+
+
+class EventBus:
+    # In-process stream of store changes and deliveries. Every event gets a
+    # sequence number; the most recent ones are kept so a late subscriber
+    # can catch up from a known position.
+
+    def __init__(self, history=4096):
+        self.seq = 0
+        self.recent = deque(maxlen=history)
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def publish(self, kind, **data):
+        with self._lock:
+            self.seq += 1
+            event = {'seq': self.seq, 'kind': kind, 'time': time.time(), **data}
+            self.recent.append(event)
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            callback(event)
+        return event
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+        return lambda: self.unsubscribe(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def since(self, seq):
+        with self._lock:
+            return [event for event in self.recent if event['seq'] > seq]
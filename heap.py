@@ -0,0 +1,87 @@
+class IndexedHeap:
+    # Binary min-heap of (priority, key) with a key -> slot map, so the
+    # priority of a queued key can be raised, lowered or removed in
+    # O(log n) without searching the heap.
+
+    def __init__(self, items=()):
+        self._heap = [(priority, key) for key, priority in items]
+        self._heap.sort()
+        self._pos = {key: i for i, (_, key) in enumerate(self._heap)}
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, key):
+        return key in self._pos
+
+    def __iter__(self):
+        # Queued keys, in no particular order.
+        return iter(self._pos)
+
+    def priority(self, key):
+        return self._heap[self._pos[key]][0]
+
+    def peek(self):
+        return self._heap[0] if self._heap else None
+
+    def push(self, key, priority):
+        # Inserts key, or moves it if it is already queued.
+        if key in self._pos:
+            return self.update(key, priority)
+        self._heap.append((priority, key))
+        self._pos[key] = len(self._heap) - 1
+        self._sift_up(len(self._heap) - 1)
+
+    def update(self, key, priority):
+        i = self._pos[key]
+        old = self._heap[i][0]
+        self._heap[i] = (priority, key)
+        if priority < old:
+            self._sift_up(i)
+        else:
+            self._sift_down(i)
+
+    def remove(self, key):
+        i = self._pos.pop(key)
+        last = self._heap.pop()
+        if i < len(self._heap):
+            self._heap[i] = last
+            self._pos[last[1]] = i
+            self._sift_up(i)
+            self._sift_down(self._pos[last[1]])
+
+    def pop(self):
+        priority, key = self._heap[0]
+        self.remove(key)
+        return priority, key
+
+    def _sift_up(self, i):
+        heap, pos = self._heap, self._pos
+        item = heap[i]
+        while i > 0:
+            parent = (i - 1) >> 1
+            if heap[parent] <= item:
+                break
+            heap[i] = heap[parent]
+            pos[heap[i][1]] = i
+            i = parent
+        heap[i] = item
+        pos[item[1]] = i
+
+    def _sift_down(self, i):
+        heap, pos = self._heap, self._pos
+        n = len(heap)
+        item = heap[i]
+        while True:
+            child = 2 * i + 1
+            if child >= n:
+                break
+            if child + 1 < n and heap[child + 1] < heap[child]:
+                child += 1
+            if item <= heap[child]:
+                break
+            heap[i] = heap[child]
+            pos[heap[i][1]] = i
+            i = child
+        heap[i] = item
+        pos[item[1]] = i
@@ -0,0 +1,36 @@
+import fcntl
+import time
+
+# 64-bit ids: milliseconds since EPOCH_MS in the high bits, a sequence in
+# the low SEQUENCE_BITS. Sorting ids sorts reminders by creation time.
+EPOCH_MS = 1577836800000  # 2020-01-01T00:00:00Z
+SEQUENCE_BITS = 22
+
+
+def id_time(reminder_id):
+    return ((reminder_id >> SEQUENCE_BITS) + EPOCH_MS) / 1000
+
+
+class IdGenerator:
+    # The last issued id is kept in a small file under flock, so ids stay
+    # unique and increasing across processes and across clock steps back.
+
+    def __init__(self, path):
+        self.path = path
+
+    def allocate(self, count=1, floor=0):
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                text = f.read().strip()
+                last = int(text) if text else 0
+                now = (int(time.time() * 1000) - EPOCH_MS) << SEQUENCE_BITS
+                start = max(now, last + 1, floor)
+                f.seek(0)
+                f.truncate()
+                f.write(str(start + count - 1))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return range(start, start + count)
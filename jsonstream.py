@@ -0,0 +1,83 @@
+import json
+
+# Read this much at a time; a value longer than that reads on in doubling
+# steps until it is complete.
+CHUNK_SIZE = 1 << 20
+WHITESPACE = ' \t\r\n'
+
+_decoder = json.JSONDecoder()
+
+
+class _Reader:
+    # A window over a text stream: what has been consumed is dropped on the
+    # next read, so memory stays at about a chunk plus the largest value.
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def more(self, size):
+        data = self.f.read(size)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        # The next character that isn't whitespace, '' at the end.
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.more(self.chunk_size):
+                return ''
+
+    def expect(self, chars):
+        found = self.peek()
+        if not found or found not in chars:
+            raise ValueError(f"expected one of {chars!r} but found {found or 'the end'!r} in the JSON stream")
+        self.pos += 1
+        return found
+
+    def value(self):
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self.more(size):
+                    raise
+                size *= 2
+                continue
+            # A number or literal that runs up to the end of what has been
+            # read may go on in the next chunk.
+            if end < len(self.buf) or self.eof or not self.more(size):
+                self.pos = end
+                return value
+
+
+def iter_object(f, chunk_size=CHUNK_SIZE):
+    # (key, value) pairs of the JSON object that makes up the text stream
+    # `f`, decoded one entry at a time.
+    reader = _Reader(f, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.pos += 1
+    else:
+        while True:
+            key = reader.value()
+            if not isinstance(key, str):
+                raise ValueError(f'expected a key but found {key!r} in the JSON stream')
+            reader.expect(':')
+            yield key, reader.value()
+            if reader.expect(',}') == '}':
+                break
+    if reader.peek():
+        raise ValueError('unexpected data after the JSON object')
@@ -0,0 +1,163 @@
+import json
+import os
+
+from timeparse import TimeParseError, parse_duration
+
+DELAY, DIGEST = 'delay', 'digest'
+# The sink reminders are normally delivered through (Scheduler.deliver).
+PRIMARY_SINK = 'desktop'
+
+
+def parse_rate(text):
+    # (count, seconds) for '10/min', '1/s', '100 per hour', '5/10min'.
+    count, sep, per = text.replace(' per ', '/').partition('/')
+    per = per.strip()
+    try:
+        count = float(count)
+    except ValueError:
+        count = -1
+    if not sep or count <= 0 or not per:
+        raise TimeParseError(f"expected a rate such as 10/min, not {text!r}")
+    seconds = parse_duration(per if per[0].isdigit() else '1 ' + per)
+    if seconds <= 0:
+        raise TimeParseError(f"expected a rate such as 10/min, not {text!r}")
+    return count, seconds
+
+
+class TokenBucket:
+    # `rate` tokens a second up to `burst`; one delivery takes one token.
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = None
+
+    def wait(self, now):
+        # Seconds until a token is available, 0 if one is now.
+        if self.stamp is not None and now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        if self.stamp is None or now > self.stamp:
+            self.stamp = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class RateLimits:
+    # Delivery limits, kept in a JSON file next to the store like the quiet
+    # hours:
+    #   {"global": {"count": 30, "per": 60, "burst": 30},
+    #    "sinks": {"webhook": {...}, "webhook:https://example.com/hook": {...}},
+    #    "users": {"*": {...}, "ann": {...}},
+    #    "overflow": "delay"}
+    # A delivery needs a token from the global bucket, its sink's and its
+    # user's. "webhook" covers every webhook URL (each with a bucket of its
+    # own), "*" every user, and reminders without a user count as user "".
+    # What doesn't get its tokens waits for them ("delay") or goes out with
+    # the rest of its user's overflow as one digest ("digest").
+
+    def __init__(self, path):
+        self.path = path
+        self.config = {}
+        self._stamp = None
+        self._buckets = {}
+
+    @property
+    def overflow(self):
+        return self.config.get('overflow', DELAY)
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def refresh(self):
+        if self._file_stamp() != self._stamp:
+            self.load()
+
+    def load(self):
+        self._stamp = self._file_stamp()
+        try:
+            with open(self.path) as f:
+                self.config = json.load(f)
+        except FileNotFoundError:
+            self.config = {}
+        self._buckets = {}
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.config, f, indent=1)
+        os.replace(tmp_path, self.path)
+        self._stamp = self._file_stamp()
+        self._buckets = {}
+
+    def set(self, rate, burst=None, sink=None, user=None):
+        # A limit for `sink`, for `user` ('*' for each user) or, with
+        # neither, the global one.
+        count, per = parse_rate(rate)
+        limit = {'count': count, 'per': per, 'burst': float(burst if burst is not None else max(count, 1))}
+        if limit['burst'] < 1:
+            raise ValueError('a burst has to allow at least one delivery')
+        if sink is not None:
+            self.config.setdefault('sinks', {})[sink] = limit
+        elif user is not None:
+            self.config.setdefault('users', {})[user] = limit
+        else:
+            self.config['global'] = limit
+        return limit
+
+    def unset(self, sink=None, user=None):
+        try:
+            if sink is not None:
+                del self.config['sinks'][sink]
+            elif user is not None:
+                del self.config['users'][user]
+            else:
+                del self.config['global']
+        except KeyError:
+            raise ValueError('no such limit') from None
+
+    def _bucket(self, key, limit):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(limit['count'] / limit['per'], limit['burst'])
+        return bucket
+
+    def buckets(self, sink, user):
+        found = []
+        if 'global' in self.config:
+            found.append(self._bucket(('global',), self.config['global']))
+        sinks = self.config.get('sinks', {})
+        limit = sinks.get(sink) or sinks.get(sink.partition(':')[0])
+        if limit:
+            found.append(self._bucket(('sink', sink), limit))
+        users = self.config.get('users', {})
+        limit = users.get(user or '') or users.get('*')
+        if limit:
+            found.append(self._bucket(('user', user or ''), limit))
+        return found
+
+    def acquire(self, now, sink, user):
+        # Takes a token from every bucket that applies and returns None, or
+        # takes none and returns the seconds until all of them have one.
+        buckets = self.buckets(sink, user)
+        wait = max((bucket.wait(now) for bucket in buckets), default=0.0)
+        if wait > 0:
+            return wait
+        for bucket in buckets:
+            bucket.take()
+        return None
+
+    def describe(self):
+        limits = [('global', None, self.config['global'])] if 'global' in self.config else []
+        for scope, mapping in (('sink', self.config.get('sinks', {})), ('user', self.config.get('users', {}))):
+            limits += [(scope, name, limit) for name, limit in sorted(mapping.items())]
+        return [{'scope': scope, 'name': name,
+                 'limit': f"{limit['count']:g}/{limit['per']:g}s burst {limit['burst']:g}"}
+                for scope, name, limit in limits]
+
@@ -0,0 +1,48 @@
+import functools
+import json
+import sys
+import threading
+import time
+import urllib.request
+
+_notification = None
+_import_lock = threading.Lock()
+
+
+def notify(name, description):
+    # plyer is imported on the first delivery only, so commands that never
+    # notify (list, export, search, ...) don't pay for it.
+    global _notification
+    if _notification is None:
+        with _import_lock:
+            if _notification is None:
+                from plyer import notification
+                _notification = notification
+    _notification.notify(title=name, message=description, timeout=5, app_name="Reminder", app_icon=r'./images/favicon.ico')
+
+
+def console(name, description):
+    print(f'[{time.strftime("%H:%M:%S")}] {name}: {description}', file=sys.stderr, flush=True)
+
+
+def webhook(url, timeout=5):
+    def send(name, description):
+        body = json.dumps({'title': name, 'message': description}).encode()
+        request = urllib.request.Request(url, body, {'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+    return send
+
+
+SINKS = {'desktop': notify, 'console': console}
+
+
+@functools.lru_cache(maxsize=None)
+def get_sink(spec):
+    # 'desktop', 'console' or 'webhook:<url>'.
+    if spec.startswith('webhook:'):
+        return webhook(spec[len('webhook:'):])
+    try:
+        return SINKS[spec]
+    except KeyError:
+        raise ValueError(f"unknown sink {spec!r}, use {', '.join(SINKS)} or webhook:<url>") from None
@@ -0,0 +1,227 @@
+import heapq
+import os
+import re
+import select
+import termios
+import tty
+
+from term import terminal_size
+
+KEYS = {
+    b'\x1b[A': 'up', b'\x1bOA': 'up',
+    b'\x1b[B': 'down', b'\x1bOB': 'down',
+    b'\x1b[5~': 'page_up', b'\x1b[6~': 'page_down',
+    b'\x1b[H': 'home', b'\x1b[F': 'end',
+    b'\r': 'enter', b'\n': 'enter',
+    b'\t': 'tab',
+    b'\x7f': 'backspace', b'\x08': 'backspace',
+    b'\x1b': 'escape', b'\x03': 'escape',
+    b'\x15': 'clear',
+}
+
+# Above this many candidates matches keep their original order; scoring a
+# huge, barely filtered set is wasted work on every keystroke.
+SCORE_LIMIT = 10000
+
+
+def fuzzy_score(query, text):
+    # Subsequence match: every query character has to appear in order. Runs
+    # of consecutive characters and matches at word starts score higher,
+    # gaps cost a little. A contiguous hit beats any scattered one.
+    # Returns None when there is no match.
+    pos = text.find(query)
+    if pos >= 0:
+        word_start = pos == 0 or not text[pos - 1].isalnum()
+        return 3 * len(query) + (4 if word_start else 2)
+    best = None
+    start = text.find(query[0])
+    for _ in range(4):
+        if start < 0:
+            break
+        score = _greedy_score(query, text, start)
+        if score is None:
+            break
+        if best is None or score > best:
+            best = score
+        start = text.find(query[0], start + 1)
+    return best
+
+
+def _greedy_score(query, text, start):
+    score = 0
+    prev = start - 1
+    for i, char in enumerate(query):
+        pos = text.find(char, prev + 1)
+        if pos < 0:
+            return None
+        if i and pos == prev + 1:
+            score += 3
+        elif pos == 0 or not text[pos - 1].isalnum():
+            score += 2
+        else:
+            score += 1 - min(pos - prev - 1, 10) * 0.1
+        prev = pos
+    return score
+
+
+class FuzzyMatcher:
+    def __init__(self, entries):
+        self.entries = entries
+        self._haystacks = [entry.lower() for entry in entries]
+        everything = range(len(entries))
+        # One (query, candidates, scores) frame per typed character, so
+        # extending the query only rescans the previous candidates and
+        # backspace simply pops back to an earlier frame.
+        self._frames = [('', everything, None)]
+        self._ranked = None
+
+    @property
+    def query(self):
+        return self._frames[-1][0]
+
+    def set_query(self, query):
+        query = query.lower()
+        while len(self._frames) > 1 and not query.startswith(self._frames[-1][0]):
+            self._frames.pop()
+        base_query, candidates, _ = self._frames[-1]
+        if query != base_query:
+            haystacks = self._haystacks
+            search = re.compile('.*?'.join(map(re.escape, query))).search
+            matches = [i for i in candidates if search(haystacks[i])]
+            scores = None
+            if len(matches) <= SCORE_LIMIT:
+                scores = {i: fuzzy_score(query, haystacks[i]) for i in matches}
+            self._frames.append((query, matches, scores))
+        self._ranked = None
+
+    def __len__(self):
+        return len(self._frames[-1][1])
+
+    def window(self, start, count):
+        # Indices into entries for ranks [start, start + count). Only the
+        # best start + count matches are ranked, not the whole candidate set.
+        query, candidates, scores = self._frames[-1]
+        if scores is None:
+            return list(candidates[start:start + count])
+        needed = start + count
+        if self._ranked is None or len(self._ranked) < min(needed, len(candidates)):
+            size = max(needed * 2, 256)
+            if size >= len(candidates):
+                self._ranked = sorted(candidates, key=lambda i: (-scores[i], i))
+            else:
+                self._ranked = heapq.nsmallest(size, candidates, key=lambda i: (-scores[i], i))
+        return self._ranked[start:start + count]
+
+
+class Picker:
+    def __init__(self, entries, title='', multi_select=False):
+        self.entries = entries
+        self.title = title
+        self.multi_select = multi_select
+        self.matcher = FuzzyMatcher(entries)
+        self.query = ''
+        self.cursor = 0
+        self.top = 0
+        self.selected = set()
+
+    def _read_key(self, fd):
+        data = os.read(fd, 1)
+        if data == b'\x1b':
+            # Collect the rest of an escape sequence if one follows at once.
+            while select.select([fd], [], [], 0.02)[0]:
+                data += os.read(fd, 1)
+                if data[-1:].isalpha() or data[-1:] == b'~':
+                    break
+        if data in KEYS:
+            return KEYS[data]
+        while True:
+            try:
+                return data.decode()
+            except UnicodeDecodeError:
+                if len(data) >= 4:
+                    return ''
+                data += os.read(fd, 1)
+
+    def _rows(self):
+        return max(terminal_size().lines - 2, 1)
+
+    def _render(self, out):
+        rows = self._rows()
+        cols = terminal_size().columns
+        if self.cursor < self.top:
+            self.top = self.cursor
+        elif self.cursor >= self.top + rows:
+            self.top = self.cursor - rows + 1
+        lines = [f'{self.title}> {self.query}'[:cols], f'  {len(self.matcher)}/{len(self.entries)}'[:cols]]
+        for rank, index in enumerate(self.matcher.window(self.top, rows), self.top):
+            mark = '*' if index in self.selected else ' '
+            line = f'{mark} {self.entries[index]}'[:cols]
+            lines.append(f'\x1b[7m{line}\x1b[0m' if rank == self.cursor else line)
+        # Home, draw only the visible rows, then clear whatever is left below.
+        out.write('\x1b[H' + '\x1b[K\r\n'.join(lines) + '\x1b[K\x1b[J')
+        out.write(f'\x1b[1;{min(len(lines[0]) + 1, cols)}H')
+        out.flush()
+
+    def _current(self):
+        window = self.matcher.window(self.cursor, 1)
+        return window[0] if window else None
+
+    def show(self):
+        # Returns the chosen entry index (or a sorted list of indices with
+        # multi_select), or None when cancelled.
+        tty_in = open('/dev/tty', 'rb', buffering=0)
+        tty_out = open('/dev/tty', 'w')
+        fd = tty_in.fileno()
+        old = termios.tcgetattr(fd)
+        try:
+            tty.setraw(fd)
+            tty_out.write('\x1b[?1049h')
+            while True:
+                self._render(tty_out)
+                key = self._read_key(fd)
+                count = len(self.matcher)
+                if key == 'escape':
+                    return None
+                elif key == 'enter':
+                    current = self._current()
+                    if self.multi_select:
+                        if not self.selected and current is not None:
+                            self.selected.add(current)
+                        return sorted(self.selected)
+                    return current
+                elif key == 'up':
+                    self.cursor = max(self.cursor - 1, 0)
+                elif key == 'down':
+                    self.cursor = max(min(self.cursor + 1, count - 1), 0)
+                elif key == 'page_up':
+                    self.cursor = max(self.cursor - self._rows(), 0)
+                elif key == 'page_down':
+                    self.cursor = max(min(self.cursor + self._rows(), count - 1), 0)
+                elif key == 'home':
+                    self.cursor = 0
+                elif key == 'end':
+                    self.cursor = max(count - 1, 0)
+                elif key == 'tab' and self.multi_select:
+                    current = self._current()
+                    if current is not None:
+                        self.selected ^= {current}
+                        self.cursor = max(min(self.cursor + 1, count - 1), 0)
+                elif key in ('backspace', 'clear') or (len(key) == 1 and key.isprintable()):
+                    if key == 'backspace':
+                        self.query = self.query[:-1]
+                    elif key == 'clear':
+                        self.query = ''
+                    else:
+                        self.query += key
+                    self.matcher.set_query(self.query)
+                    self.cursor = self.top = 0
+        finally:
+            tty_out.write('\x1b[?1049l')
+            tty_out.flush()
+            termios.tcsetattr(fd, termios.TCSADRAIN, old)
+            tty_in.close()
+            tty_out.close()
+
+
+def pick(entries, title='', multi_select=False):
+    return Picker(entries, title, multi_select).show()
@@ -0,0 +1,42 @@
+import functools
+import time
+
+from store import ReminderNotFound, occurrences
+from zones import zone_table
+
+
+def format_time(when, zone=None):
+    # In the system's local time, or on the wall clock of an IANA zone.
+    if zone is None:
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when))
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(zone_table(zone).to_wall(when)))
+
+
+class ReminderPreview:
+    # Preview callable for Menu(preview_command=...), given a reminder id.
+    # Rendered text is cached per (id, store version), so moving the cursor back over a reminder
+    # that has not changed costs a dict lookup.
+
+    def __init__(self, store, occurrence_count=5, cache_size=512):
+        self.store = store
+        self.occurrence_count = occurrence_count
+        self._render = functools.lru_cache(maxsize=cache_size)(self._render_uncached)
+
+    def __call__(self, key):
+        key = int(key)
+        return self._render(key, self.store.version(key))
+
+    def _render_uncached(self, key, version):
+        try:
+            record = self.store.get(key)
+        except ReminderNotFound:
+            return f'#{key}\n\n(removed)'
+        zone = record.get('tz')
+        lines = [f"{record['name']}  #{key}", '', record['description'] or '(no description)', '', 'Next:']
+        lines += ['  ' + format_time(when, zone) for when in occurrences(record, self.occurrence_count)]
+        if record.get('every'):
+            lines.append(f"  ... every {record['every']:g}s" + (f' {zone} time' if zone else ''))
+        lines += ['', 'Delivered:']
+        history = record.get('history', [])
+        lines += ['  ' + format_time(when, zone) for when in reversed(history)] or ['  never']
+        return '\n'.join(lines)
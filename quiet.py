@@ -0,0 +1,173 @@
+import datetime
+import json
+import os
+from bisect import bisect_right
+
+from preview import format_time
+from timeparse import TimeParseError, compile_expression
+from zones import find_zone, local_to_utc, zone_table
+
+# Recurring windows are expanded into concrete intervals this far ahead
+# and rebuilt once half of that has passed.
+HORIZON = 8 * 86400
+DEFER, DIGEST = 'defer', 'digest'
+
+
+def parse_clock(text):
+    # Seconds after midnight for '22:00', '7am', 'noon', ...
+    when, every, _ = compile_expression(text)
+    if when[0] != 'local' or when[1] is not None or every is not None:
+        raise TimeParseError(f'expected a time of day, not {text!r}')
+    return when[2]
+
+
+def format_clock(clock):
+    return '%02d:%02d' % divmod(clock // 60, 60)
+
+
+class WindowIndex:
+    # Intervals sorted by start with a running maximum of their ends. The
+    # interval reaching furthest among those starting at or before t is the
+    # only one that matters for "is t covered, and until when", so a stab
+    # is one bisect however many windows there are.
+
+    def __init__(self, intervals):
+        intervals = sorted(intervals)
+        self.starts = [start for start, _, _ in intervals]
+        self.reach = []
+        best = None
+        for interval in intervals:
+            if best is None or interval[1] > best[1]:
+                best = interval
+            self.reach.append(best)
+
+    def covering(self, t):
+        # (end, action) of the covering window that ends last, or None.
+        i = bisect_right(self.starts, t) - 1
+        if i < 0:
+            return None
+        _, end, action = self.reach[i]
+        return (end, action) if end > t else None
+
+
+class QuietHours:
+    # Quiet-hour and do-not-disturb windows, kept in a JSON file next to
+    # the store so every process sees the same ones:
+    #   {"user": null, "start": 79200, "end": 25200, "days": [0, 1, 2, 3, 4],
+    #    "tz": "Europe/Berlin", "action": "defer"}     every day 22:00-07:00
+    #   {"user": "ann", "from": 1792000000, "until": 1792007200, "action": "digest"}
+    # "user": null applies to everyone. A reminder coming due inside a
+    # window is deferred to its end, or folded into one digest there.
+
+    def __init__(self, path):
+        self.path = path
+        self.windows = []
+        self._stamp = None
+        self._indexes = {}
+        self._built = None
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def refresh(self):
+        stamp = self._file_stamp()
+        if stamp != self._stamp:
+            self.load()
+
+    def load(self):
+        self._stamp = self._file_stamp()
+        try:
+            with open(self.path) as f:
+                self.windows = json.load(f)
+        except FileNotFoundError:
+            self.windows = []
+        self._built = None
+
+    def save(self, now):
+        # Ad-hoc windows that are over are dropped.
+        self.windows = [window for window in self.windows if window.get('until', now + 1) > now]
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.windows, f, indent=1)
+        os.replace(tmp_path, self.path)
+        self._stamp = self._file_stamp()
+        self._built = None
+
+    def add_daily(self, start, end, user=None, days=None, tz=None, action=DEFER):
+        window = {'user': user, 'start': parse_clock(start), 'end': parse_clock(end),
+                  'days': sorted(set(days)) if days else list(range(7)), 'action': action}
+        if tz:
+            window['tz'] = find_zone(tz)
+        self.windows.append(window)
+        return window
+
+    def add_block(self, start, end, user=None, action=DEFER):
+        if end <= start:
+            raise ValueError('a do-not-disturb block has to end after it starts')
+        window = {'user': user, 'from': float(start), 'until': float(end), 'action': action}
+        self.windows.append(window)
+        return window
+
+    def _intervals(self, window, since, until):
+        if 'from' in window:
+            yield window['from'], window['until'], window['action']
+            return
+        zone = window.get('tz')
+        now = since + 86400
+        today = zone_table(zone).today(now) if zone else datetime.date.fromtimestamp(now)
+        start, end = window['start'], window['end']
+        length = (end - start) % 86400 or 86400
+        for offset in range(-2, int((until - since) // 86400) + 2):
+            date = today + datetime.timedelta(days=offset)
+            if date.weekday() not in window['days']:
+                continue
+            begin = local_to_utc(date, start, zone)
+            # Measured on the wall clock, so a window across a DST change
+            # still ends at its local end time.
+            finish = local_to_utc(date + datetime.timedelta(days=(start + length) // 86400),
+                                  (start + length) % 86400, zone)
+            if finish > since and begin < until:
+                yield begin, finish, window['action']
+
+    def _build(self, now):
+        since, until = now - 86400, now + HORIZON
+        intervals = {}
+        for window in self.windows:
+            intervals.setdefault(window.get('user'), []).extend(self._intervals(window, since, until))
+        self._indexes = {user: WindowIndex(found) for user, found in intervals.items()}
+        self._built = (since, now + HORIZON / 2)
+
+    def check(self, when, user=None):
+        # (end, action, window_user) when `when` is quiet for `user`, else
+        # None. Back-to-back or overlapping windows are followed to where
+        # the last of them ends; the first one decides the action.
+        if self._built is None or not self._built[0] <= when < self._built[1]:
+            self._build(when)
+        found = None
+        t = when
+        while True:
+            hit = None
+            for owner in (None, user) if user is not None else (None,):
+                index = self._indexes.get(owner)
+                covering = index.covering(t) if index is not None else None
+                if covering is not None and (hit is None or covering[0] > hit[0]):
+                    hit = covering + (owner,)
+            if hit is None:
+                return found
+            found = (hit[0], found[1], found[2]) if found else hit
+            t = hit[0]
+
+    def describe(self, window):
+        if 'from' in window:
+            span = f"{format_time(window['from'])} - {format_time(window['until'])}"
+        else:
+            days = 'every day' if len(window['days']) == 7 else ','.join(
+                'mon tue wed thu fri sat sun'.split()[day] for day in window['days'])
+            span = f"{format_clock(window['start'])}-{format_clock(window['end'])} {days}"
+            if window.get('tz'):
+                span += ' ' + window['tz']
+        return f"{span}  {window.get('user') or 'everyone'}  {window['action']}"
@@ -1,42 +1,521 @@
+import argparse
+import asyncio
 import json
+import os
+import sys
 from socket import timeout
 import time
-from plyer import notification
-from simple_term_menu import TerminalMenu
-
-Reminders = {}
-f = open('cache.json')
-Reminders_created = json.load(f)
-def show_term_menu():
-    options = ["Add reminder", "Remove reminder", "show reminders"]
-    terminal_menu = TerminalMenu(options)
+
+from api import ReminderAPI, serve
+from dashboard import Dashboard
+from events import EventBus
+from limits import DELAY, RateLimits
+from notifier import notify
+from picker import pick
+from digest import compile_template
+from preview import ReminderPreview, format_time
+from quiet import DEFER, DIGEST, QuietHours
+from scheduler import DROP, Scheduler
+from spread import spread_report
+from store import (CACHE_PATH, PRIORITIES, AmbiguousReminder, ReminderNotFound, ReminderStore, make_record,
+                   normalize_record, records_from_input, to_row)
+from term import Menu, terminal_size
+from timeparse import WEEKDAYS, TimeParseError, parse_duration, parse_instant, parse_schedule, parse_time
+
+
+def show_term_menu(store):
+    # Handles one menu action; returns False once the user quits.
+    options = ["Add reminder", "Remove reminder", "Snooze reminder", "Browse reminders", "show reminders", "Quit"]
+    terminal_menu = Menu(options)
     menu_entry_index = terminal_menu.show()
+    if menu_entry_index is None or options[menu_entry_index] == "Quit":
+        return False
     print(f'You have selected:{options[menu_entry_index]}!')
 
     if options[menu_entry_index] == "Add reminder":
         rem_name = str(input("Name of your reminder: "))
         rem_description = str(input("Your reminders description: "))
-        rem_time = float(input("Time:"))
-        add_reminder(rem_name, rem_time, rem_description)
+        while True:
+            try:
+                rem_due, rem_every, rem_tz = parse_schedule(
+                    input("Time (seconds, 'in 20 minutes', 'tomorrow 9am', 'every day 09:00 Europe/Berlin', ...): "))
+                break
+            except TimeParseError as e:
+                print(e)
+        store.add(make_record(rem_name, rem_description, due=rem_due, every=rem_every, tz=rem_tz))
+
+    elif options[menu_entry_index] == "Remove reminder":
+        ids = pick_reminders(store, 'remove')
+        if ids:
+            store.remove_many(ids)
+            print(f'Removed {len(ids)} reminder(s).')
+
+    elif options[menu_entry_index] == "Snooze reminder":
+        ids = pick_reminders(store, 'snooze')
+        if ids:
+            while True:
+                try:
+                    seconds = parse_duration(input("Snooze for (seconds, '10 min', '1h30m', ...): "))
+                    break
+                except TimeParseError as e:
+                    print(e)
+            store.snooze_many(ids, seconds)
+            print(f'Snoozed {len(ids)} reminder(s).')
+
+    elif options[menu_entry_index] == "Browse reminders":
+        browse_reminders(store)
 
     elif options[menu_entry_index] == "show reminders":
-        print(Reminders_created)
+        page_reminders(store)
 
+    return True
 
-def show_reminders(local_time_assigned, name, description):
-    local_time = local_time_assigned 
-    time.sleep(local_time)
-    notification.notify(title=name, message=description, timeout=5, app_name="Reminder", app_icon=r'./images/favicon.ico')
 
+def run_session(store):
+    # Keeps the store, its indexes and the notifier loaded across actions;
+    # reminders are delivered in the background while the menu is open.
+    scheduler = Scheduler(store, notify)
+    scheduler.start()
+    try:
+        while show_term_menu(store):
+            pass
+    finally:
+        scheduler.stop()
 
-    
-def add_reminder(name, time, description):
-    Reminders[name] = ({'time': time, 'description': description})
-    with open('cache.json', 'w') as f:
-        json.dump(Reminders, f)
-    show_reminders(time, name, description)
 
-if __name__ == '__main__':
-    show_term_menu()
+def menu_entry(text, data):
+    # The part after the first unescaped '|' is what the preview callable
+    # receives, so a '|' in the text is escaped. The space keeps a
+    # backslash at the end of the text from escaping the separator.
+    return text.replace('|', '\\|') + ' |' + data
+
+
+def browse_reminders(store):
+    entries = [menu_entry(format_row(to_row(key, record)), str(key)) for key, record in store.iter_due()]
+    if entries:
+        Menu(entries, preview_command=ReminderPreview(store), preview_size=0.5).show()
+
+
+def pick_reminders(store, title):
+    # Fuzzy picker over all reminders in due order; tab marks several.
+    ids = [key for key, _ in store.iter_due()]
+    entries = [format_row(to_row(key, store.get(key))) for key in ids]
+    chosen = pick(entries, title=title, multi_select=True)
+    return [ids[i] for i in chosen or ()]
+
+
+def page_reminders(store, page_size=None):
+    if page_size is None:
+        page_size = max(terminal_size().lines - 2, 1)
+    offset = 0
+    while True:
+        rows = [to_row(key, record) for key, record in store.iter_due(offset=offset, limit=page_size)]
+        write_rows(rows, 'text')
+        offset += len(rows)
+        if offset >= len(store):
+            break
+        if input('-- more (enter / q) --').strip().lower() == 'q':
+            break
+
+
+def write_rows(rows, fmt, out=sys.stdout):
+    if fmt == 'json':
+        # Stream the array element by element instead of building it first.
+        out.write('[')
+        for i, row in enumerate(rows):
+            out.write((', ' if i else '') + json.dumps(row))
+        out.write(']\n')
+    elif fmt == 'ndjson':
+        for row in rows:
+            out.write(json.dumps(row) + '\n')
+    else:
+        for row in rows:
+            out.write(format_row(row) + '\n')
+
+
+def format_row(row):
+    return f"{format_time(row['due'])}  {row['id']}  {row['name']}  {row['description']}"
+
+
+def parse_reminder_input(text, base_time=None):
+    # Accepts a JSON array of reminders, a single reminder object, a
+    # cache.json-style {key: record} mapping, or one reminder per line.
+    # Returns records; the store gives them new ids.
+    now = time.time()
+    text = text.strip()
+    if not text:
+        return []
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        return records_from_input((json.loads(line) for line in text.splitlines() if line.strip()), now)
+    if isinstance(data, list):
+        return records_from_input(data, now)
+    if not isinstance(data, dict):
+        raise ValueError(f'expected reminders, not {data!r}')
+    if 'name' in data:
+        return records_from_input([data], now)
+    base_time = now if base_time is None else base_time
+    # Older cache files are keyed by name and have no 'name' field.
+    if not all(isinstance(rec, dict) for rec in data.values()):
+        raise ValueError('expected a reminder object for every key')
+    return [normalize_record(dict(rec, name=rec.get('name', key)), base_time) for key, rec in data.items()]
+
+
+def escalation_args(args):
+    if args.renotify is None:
+        if args.times is not None or args.escalate_to:
+            raise ValueError('--times and --escalate-to need --renotify')
+        return None
+    times = 3 if args.times is None else args.times
+    return {'every': parse_duration(args.renotify), 'times': times, 'to': args.escalate_to or []}
+
+
+def chain_args(store, args):
+    if args.after is None:
+        if args.on is not None or args.delay is not None:
+            raise ValueError('--on and --delay need --after')
+        return None
+    return {'id': store.resolve(args.after), 'on': args.on or 'fired', 'delay': args.delay or 0}
+
+
+def cmd_add(store, args):
+    escalate = escalation_args(args)
+    after = chain_args(store, args)
+    if args.name in (None, '-'):
+        records = parse_reminder_input(sys.stdin.read())
+    elif args.due is not None:
+        records = [make_record(args.name, args.description, due=args.due, every=args.every, tz=args.tz,
+                               user=args.user, digest=args.digest, escalate=escalate, after=after,
+                               priority=args.priority)]
+    else:
+        due, every, tz = parse_schedule(args.time, zone=args.tz)
+        records = [make_record(args.name, args.description, due=due, every=args.every or every, tz=tz,
+                               user=args.user, digest=args.digest, escalate=escalate, after=after,
+                               priority=args.priority)]
+    write_rows((to_row(key, record) for key, record in store.add_many(records)), args.format)
+
+
+def time_range(args):
+    # --since and --until as unix timestamps.
+    now = time.time()
+    return tuple(None if value is None else parse_instant(value, now) for value in (args.since, args.until))
+
+
+def cmd_list(store, args):
+    if args.offset < 0 or (args.limit is not None and args.limit < 0):
+        raise ValueError('--offset and --limit cannot be negative')
+    since, until = time_range(args)
+    reminders = store.iter_due(since=since, until=until, offset=args.offset, limit=args.limit)
+    write_rows((to_row(key, record) for key, record in reminders), args.format)
+
+
+def cmd_remove(store, args):
+    removed = store.remove_many(store.resolve_many(args.reminders))
+    write_rows((to_row(key, record) for key, record in removed), args.format)
+
+
+def cmd_snooze(store, args):
+    key = store.resolve(args.reminder)
+    write_rows([to_row(key, store.snooze(key, parse_duration(args.seconds)))], args.format)
+
+
+def cmd_ack(store, args):
+    acked = store.ack_many(store.resolve_many(args.reminders))
+    write_rows((to_row(key, record) for key, record in acked), args.format)
+
+
+def cmd_chain(store, args):
+    key = store.resolve(args.reminder)
+    after = {'id': store.resolve(args.after), 'on': args.on or 'fired', 'delay': args.delay or 0}
+    write_rows([to_row(key, store.chain(key, after))], args.format)
+
+
+def cmd_search(store, args):
+    rows = []
+    for key, record, score in store.search(args.query, args.limit):
+        row = to_row(key, record)
+        row['score'] = round(score, 3)
+        rows.append(row)
+    write_rows(rows, args.format)
+
+
+def cmd_reschedule(store, args):
+    key = store.resolve(args.reminder)
+    write_rows([to_row(key, store.reschedule(key, parse_instant(args.due)))], args.format)
+
+
+def cmd_import(store, args):
+    if args.file == '-':
+        records = parse_reminder_input(sys.stdin.read())
+    else:
+        try:
+            with open(args.file) as f:
+                text, base_time = f.read(), os.fstat(f.fileno()).st_mtime
+        except OSError as e:
+            raise ValueError(f'cannot read {args.file}: {e.strerror}') from None
+        records = parse_reminder_input(text, base_time=base_time)
+    store.add_many(records)
+    write_rows([{'imported': len(records)}], 'ndjson' if args.format == 'text' else args.format)
+
+
+def cmd_export(store, args):
+    write_rows((to_row(key, record) for key, record in store.items()), args.format)
+
 
-f.close()
\ No newline at end of file
+def cmd_digest(store, args):
+    # A repeating reminder that delivers the user's digest reminders due by
+    # then as one notification.
+    due, every, tz = parse_schedule(args.time, zone=args.tz)
+    if not every:
+        raise ValueError(f"a digest has to repeat, e.g. 'every day 18:00', not {args.time!r}")
+    if args.template:
+        compile_template(args.template)
+    record = make_record(args.name, f'digest every {every:g}s', due=due, every=every, tz=tz, user=args.user,
+                         kind='digest', template=args.template)
+    write_rows((to_row(key, record) for key, record in store.add_many([record])), args.format)
+
+
+def cmd_quiet(store, args):
+    quiet = QuietHours(store.quiet_path)
+    quiet.load()
+    action = DIGEST if args.digest else DEFER
+    if args.remove is not None:
+        if not 0 <= args.remove < len(quiet.windows):
+            raise ValueError(f'no quiet window {args.remove}')
+        del quiet.windows[args.remove]
+        quiet.save(time.time())
+    elif args.start is not None:
+        if args.end is None:
+            raise ValueError('a quiet window needs an end time')
+        days = None
+        if args.days:
+            try:
+                days = [WEEKDAYS[day.strip().lower()] for day in args.days.split(',')]
+            except KeyError as e:
+                raise ValueError(f'unknown weekday {e.args[0]!r}') from None
+        quiet.add_daily(args.start, args.end, user=args.user, days=days, tz=args.tz, action=action)
+        quiet.save(time.time())
+    write_rows([{'window': i, 'quiet': quiet.describe(window)} for i, window in enumerate(quiet.windows)],
+               args.format)
+
+
+def cmd_dnd(store, args):
+    quiet = QuietHours(store.quiet_path)
+    quiet.load()
+    now = time.time()
+    quiet.add_block(now, parse_time(args.until, now), user=args.user, action=DIGEST if args.digest else DEFER)
+    quiet.save(now)
+    write_rows([{'window': len(quiet.windows) - 1, 'quiet': quiet.describe(quiet.windows[-1])}], args.format)
+
+
+def cmd_limit(store, args):
+    limits = RateLimits(store.limits_path)
+    limits.load()
+    if args.overflow:
+        limits.config['overflow'] = args.overflow
+    if args.remove:
+        limits.unset(args.sink, args.user)
+    elif args.rate:
+        limits.set(args.rate, args.burst, args.sink, args.user)
+    if args.overflow or args.remove or args.rate:
+        limits.save()
+    write_rows(limits.describe() + [{'overflow': limits.overflow}], args.format)
+
+
+def cmd_spread(store, args):
+    # What --spread would do to the per-second load of what is due.
+    window = parse_duration(args.window)
+    since, until = time_range(args)
+    items = [(key, record['due']) for key, record in store.iter_due(since=since, until=until)
+             if not (record.get('digest') or record.get('done') or 'after' in record)]
+    write_rows(spread_report(items, window, top=args.top), args.format)
+
+
+def make_scheduler(store, args):
+    shed_after = parse_duration(args.shed_after) if args.shed_after is not None else None
+    spread = parse_duration(args.spread) if args.spread is not None else 0
+    return Scheduler(store, notify, shed_after=shed_after, shed_action=args.shed_action,
+                     shed_priority=args.shed_priority, spread=spread)
+
+
+def cmd_run(store, args):
+    make_scheduler(store, args).run()
+
+
+def cmd_serve(store, args):
+    # The HTTP API and the scheduler share one store in this process.
+    scheduler = make_scheduler(store, args)
+    api = ReminderAPI(store)
+    scheduler.start()
+    try:
+        asyncio.run(serve(api, args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scheduler.stop()
+
+
+def cmd_dashboard(store, args):
+    # Only watches: deliveries are left to the `serve` daemon, whose event
+    # stream it follows for those and for store changes.
+    Dashboard(store, (args.host, args.port, args.socket), count=args.count).run()
+
+
+def add_chain_arguments(sub, after):
+    sub.add_argument(after, metavar='REMINDER', help='only come due once this reminder (id or name) fires')
+    sub.add_argument('--on', choices=('fired', 'acked'), help="or once it is acked (default: fired)")
+    sub.add_argument('--delay', metavar='INTERVAL', help="that long after it, e.g. '30 min' (default: right away)")
+
+
+def add_range_arguments(sub):
+    sub.add_argument('--since', help="only reminders due at or after this, a unix timestamp or e.g. 'today 9am'")
+    sub.add_argument('--until', help="only reminders due at or before this, e.g. 'in 2 days'")
+
+
+def add_dispatch_arguments(sub):
+    sub.add_argument('--shed-after', metavar='INTERVAL',
+                     help="under a backlog, don't deliver reminders this late one by one, e.g. '10 min'")
+    sub.add_argument('--shed-action', choices=(DIGEST, DROP), default=DIGEST,
+                     help='send them as one digest or drop them (default: %(default)s)')
+    sub.add_argument('--shed-priority', choices=PRIORITIES, default='low',
+                     help='only reminders of this priority or lower (default: %(default)s)')
+    sub.add_argument('--spread', metavar='INTERVAL',
+                     help="deliver reminders due on the hour or half hour up to this much later, e.g. '2 min'")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Desktop reminders.')
+    parser.add_argument('--cache', default=CACHE_PATH, help='path of the reminder store (default: %(default)s)')
+    subparsers = parser.add_subparsers(dest='command')
+
+    def add_command(name, handler, default_format='ndjson', **kwargs):
+        sub = subparsers.add_parser(name, **kwargs)
+        sub.add_argument('--format', choices=('text', 'json', 'ndjson'), default=default_format)
+        sub.set_defaults(handler=handler)
+        return sub
+
+    sub = add_command('add', cmd_add, help='add one reminder, or many from stdin')
+    sub.add_argument('name', nargs='?', help="reminder name; omit or pass '-' to read reminders from stdin")
+    sub.add_argument('-d', '--description', default='')
+    when = sub.add_mutually_exclusive_group()
+    when.add_argument('-t', '--time', default='0',
+                      help="seconds from now, or e.g. 'in 20 minutes', 'tomorrow 9am', 'next friday 14:30'")
+    when.add_argument('--due', type=float, help='absolute due time as a unix timestamp')
+    sub.add_argument('--every', type=float, help='repeat every this many seconds')
+    sub.add_argument('--tz', help='IANA time zone to read the time in and repeat on, e.g. Europe/Berlin')
+    sub.add_argument('--user', help='whose quiet hours and digest apply to this reminder')
+    sub.add_argument('--digest', action='store_true', help="deliver in the user's next digest, not on its own")
+    sub.add_argument('--renotify', metavar='INTERVAL',
+                     help="until acked, notify again this often, e.g. '10 minutes' (plain numbers are seconds)")
+    sub.add_argument('--times', type=int, help='re-notifications before escalating (default: 3)')
+    sub.add_argument('--escalate-to', action='append', metavar='SINK',
+                     help="then notify this sink: desktop, console or webhook:<url>; repeat for a chain")
+    add_chain_arguments(sub, '--after')
+    sub.add_argument('--priority', choices=PRIORITIES, help='delivery order under a backlog (default: normal)')
+
+    sub = add_command('list', cmd_list, default_format='text', help='list reminders by due time')
+    sub.add_argument('--limit', type=int, help='show at most this many reminders')
+    sub.add_argument('--offset', type=int, default=0, help='skip this many reminders first')
+    add_range_arguments(sub)
+
+    sub = add_command('remove', cmd_remove, help='remove reminders by id or name')
+    sub.add_argument('reminders', nargs='+', metavar='reminder')
+
+    sub = add_command('snooze', cmd_snooze, help='push a reminder back')
+    sub.add_argument('reminder', help='id, or a name only one reminder has')
+    sub.add_argument('seconds', metavar='duration', help="seconds, or e.g. '10 min' or '1h30m'")
+
+    sub = add_command('reschedule', cmd_reschedule, help='move a reminder to a new due time')
+    sub.add_argument('reminder', help='id, or a name only one reminder has')
+    sub.add_argument('due', help="new due time as a unix timestamp, or e.g. 'tomorrow 9am'")
+
+    sub = add_command('ack', cmd_ack, help='acknowledge delivered reminders, stopping their escalation')
+    sub.add_argument('reminders', nargs='+', metavar='reminder')
+
+    sub = add_command('chain', cmd_chain, help='make a reminder wait for another to fire or be acked')
+    sub.add_argument('reminder', help='id, or a name only one reminder has')
+    add_chain_arguments(sub, 'after')
+
+    sub = add_command('search', cmd_search, default_format='text', help='full-text search over names and descriptions')
+    sub.add_argument('query', help='words to look for; each word also matches as a prefix')
+    sub.add_argument('--limit', type=int, default=20)
+
+    sub = add_command('import', cmd_import, help='import reminders from a file')
+    sub.add_argument('file', help="JSON, NDJSON or cache.json file, or '-' for stdin")
+
+    add_command('export', cmd_export, default_format='json', help='export all reminders')
+
+    sub = add_command('digest', cmd_digest, help='deliver --digest reminders together at fixed times')
+    sub.add_argument('name', nargs='?', default='Digest')
+    sub.add_argument('-t', '--time', default='every day 18:00', help="when it goes out (default: '%(default)s')")
+    sub.add_argument('--tz', help='IANA time zone of the time')
+    sub.add_argument('--user', help='collect the digest reminders of this user (default: those without a user)')
+    sub.add_argument('--template', help="line per reminder, e.g. '{time} {name}: {description}'; "
+                                        "fields: id, time, name, description, user")
+
+    sub = add_command('quiet', cmd_quiet, help='list, add or remove daily quiet hours')
+    sub.add_argument('start', nargs='?', help="start of the window, e.g. '22:00'")
+    sub.add_argument('end', nargs='?', help="end of the window, e.g. '7am'")
+    sub.add_argument('--days', help='weekdays the window starts on, e.g. mon,tue,wed (default: every day)')
+    sub.add_argument('--tz', help='IANA time zone of the window (default: local time)')
+    sub.add_argument('--user', help='only for reminders of this user (default: everyone)')
+    sub.add_argument('--digest', action='store_true', help='fold reminders into one digest at the end')
+    sub.add_argument('--remove', type=int, metavar='N', help='remove window N')
+
+    sub = add_command('dnd', cmd_dnd, help='do not disturb from now until a given time')
+    sub.add_argument('until', help="e.g. 'in 2 hours' or '14:00'")
+    sub.add_argument('--user', help='only for reminders of this user (default: everyone)')
+    sub.add_argument('--digest', action='store_true', help='fold reminders into one digest at the end')
+    sub = add_command('limit', cmd_limit, help='list or set delivery rate limits')
+    sub.add_argument('rate', nargs='?', help="e.g. '30/min' or '1/s'")
+    scope = sub.add_mutually_exclusive_group()
+    scope.add_argument('--sink', help="limit one sink, e.g. desktop, webhook (all of them) or webhook:<url>")
+    scope.add_argument('--user', help="limit one user, or '*' for each user (default: the global limit)")
+    sub.add_argument('--burst', type=float, help='deliveries allowed at once (default: the count of the rate)')
+    sub.add_argument('--overflow', choices=(DELAY, DIGEST),
+                     help='whether held back reminders wait for their turn or go out as one digest')
+    sub.add_argument('--remove', action='store_true', help='remove the limit instead')
+
+    sub = add_command('spread', cmd_spread, help='show how --spread would flatten per-second delivery peaks')
+    sub.add_argument('window', help="the --spread interval to try, e.g. '2 min'")
+    add_range_arguments(sub)
+    sub.add_argument('--top', type=int, default=10, help='busiest seconds to list (default: %(default)s)')
+
+    sub = add_command('run', cmd_run, help='deliver reminders as they come due')
+    add_dispatch_arguments(sub)
+    sub = add_command('serve', cmd_serve, help='deliver reminders and serve the HTTP API')
+    add_dispatch_arguments(sub)
+    sub.add_argument('--host', default='127.0.0.1')
+    sub.add_argument('--port', type=int, default=8765)
+    sub.add_argument('--socket', help='listen on this Unix socket instead of TCP')
+    sub = add_command('dashboard', cmd_dashboard, help="show live countdowns and what the `serve` daemon delivers")
+    sub.add_argument('--count', type=int, default=10, help='number of upcoming reminders to show')
+    sub.add_argument('--host', default='127.0.0.1', help='where the daemon serves its API')
+    sub.add_argument('--port', type=int, default=8765)
+    sub.add_argument('--socket', help="the daemon's Unix socket instead of TCP")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    store = ReminderStore(args.cache, events=EventBus())
+    if args.command is None:
+        run_session(store)
+        return 0
+    try:
+        args.handler(store, args)
+    except ReminderNotFound as e:
+        print(f'No such reminder: {e.args[0]}', file=sys.stderr)
+        return 1
+    except AmbiguousReminder as e:
+        print(f'Several reminders are called {e.name!r}, use an id: {" ".join(map(str, e.ids))}', file=sys.stderr)
+        return 1
+    except ValueError as e:
+        print(f'Invalid input: {e}', file=sys.stderr)
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
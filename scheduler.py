@@ -0,0 +1,343 @@
+import math
+import sys
+import threading
+import time
+
+from digest import render_digest
+from heap import IndexedHeap
+from limits import PRIMARY_SINK, RateLimits
+from notifier import get_sink
+from preview import format_time
+from quiet import DIGEST, QuietHours
+from spread import jitter
+from store import FLAG_UNACKED, IDLE_FLAGS, NORMAL, PRIORITIES, flags_priority, next_followup, record_flags
+
+# How late, in seconds, a reminder of each priority may go out. Whatever
+# is due is delivered earliest deadline (due time plus this) first, so
+# under a backlog a critical reminder overtakes older low ones.
+SLO = {'critical': 0, 'high': 60, 'normal': 300, 'low': 1800}
+DROP = 'drop'
+# The queue holds what is due up to a horizon, read from the store's due
+# order this many reminders at a time as the queue runs out.
+WINDOW_SIZE = 1024
+
+
+class Scheduler:
+    # Delivers reminders from the store as they come due, either in the
+    # foreground (`run`) or on a background thread inside a session.
+
+    def __init__(self, store, deliver, poll_interval=1.0, quiet=None, slo=None, shed_after=None,
+                 shed_action=DIGEST, shed_priority='low', limits=None, spread=0):
+        self.store = store
+        self.deliver = deliver
+        self.poll_interval = poll_interval
+        self.slo = dict(SLO, **(slo or {}))
+        # Reminders of shed_priority or below that are more than shed_after
+        # seconds late when their turn comes are dropped (DROP) or all sent
+        # as one digest (DIGEST) rather than one by one.
+        self.shed_after = shed_after
+        self.shed_action = shed_action
+        self.shed_rank = PRIORITIES.index(shed_priority)
+        self.limits = RateLimits(store.limits_path) if limits is None else limits
+        # Reminders due on the hour or half hour go out up to this many
+        # seconds late, spread by id (see spread.py).
+        self.spread = spread
+        # user -> [retry at, ids] of reminders held back by a rate limit,
+        # to go out as one digest once the user's buckets allow it.
+        self._overflow = {}
+        self.quiet = QuietHours(store.quiet_path) if quiet is None else quiet
+        # (window user, window end) of quiet windows whose reminders go out
+        # as one digest when the window ends.
+        self._folds = set()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        # Due times by id of the reminders due up to `horizon`, kept in step
+        # with the store through its observer hook: a snooze or reschedule
+        # is a single heap update. A reminder waiting for an ack also has
+        # its next follow-up in here, under the negated id; nothing else is
+        # kept per pending escalation.
+        self.queue = IndexedHeap()
+        self.horizon = -math.inf
+        # What has come due, moved over from `queue` and keyed by
+        # (deadline, due) for dispatch.
+        self.ready = IndexedHeap()
+        with store.lock:
+            self._on_change(None, None)
+            store.observers.append(self._on_change)
+
+    def close(self):
+        with self.store.lock:
+            if self._on_change in self.store.observers:
+                self.store.observers.remove(self._on_change)
+
+    def _entries(self, key, due, flags):
+        # Reminders that go out in a digest, were delivered and only wait
+        # for an ack, or wait on a chain are never due on their own. Only
+        # those waiting for an ack are read beyond their (id, due, flags).
+        if not flags & IDLE_FLAGS:
+            yield key, due + jitter(key, due, self.spread)
+        if flags & FLAG_UNACKED:
+            yield -key, next_followup(self.store.get(key))
+
+    def _on_change(self, key, record):
+        if key is None:
+            # Follow-ups are not in due order, but few reminders wait for an
+            # ack; everything else is read again as the queue runs out.
+            self.queue = IndexedHeap((-key, next_followup(self.store.get(key))) for key in self.store.unacked)
+            self.ready = IndexedHeap()
+            self.horizon = -math.inf
+        else:
+            entries = {}
+            if record is not None:
+                entries = dict(self._entries(key, record['due'], record_flags(record)))
+                if record['due'] > self.horizon:
+                    entries.pop(key, None)
+            for queued in (key, -key):
+                if queued in self.ready:
+                    self.ready.remove(queued)
+                if queued in entries:
+                    self.queue.push(queued, entries[queued])
+                elif queued in self.queue:
+                    self.queue.remove(queued)
+        self._wakeup.set()
+
+    def _extend(self):
+        # Queues the next WINDOW_SIZE reminders past the horizon (and any
+        # others due when the last of them is) and moves it on.
+        last, count = None, 0
+        for due, key in self.store.due_index.range(since=self.horizon):
+            if due <= self.horizon:
+                continue
+            if count >= WINDOW_SIZE and due > last:
+                self.horizon = last
+                return
+            if not self.store.hot(key)[1] & IDLE_FLAGS:
+                self.queue.push(key, due + jitter(key, due, self.spread))
+            last, count = due, count + 1
+        self.horizon = math.inf
+
+    def _head(self):
+        # The first entry of the queue, once nothing past the horizon could
+        # come before it.
+        head = self.queue.peek()
+        while self.horizon < math.inf and (head is None or head[0] > self.horizon):
+            self._extend()
+            head = self.queue.peek()
+        return head
+
+    def _promote(self, now):
+        while True:
+            head = self._head()
+            if head is None or head[0] > now:
+                return
+            due, key = self.queue.pop()
+            priority = flags_priority(self.store.hot(abs(key))[1])
+            self.ready.push(key, (due + self.slo[priority], due))
+
+    def _too_late(self, key, now):
+        if self.shed_after is None or key < 0:
+            return False
+        record = self.store.get(key)
+        if record.get('kind') == 'digest' or PRIORITIES.index(record.get('priority', NORMAL)) < self.shed_rank:
+            return False
+        return now - self.ready.priority(key)[1] > self.shed_after
+
+    def _sink(self, key, record):
+        if key > 0:
+            return PRIMARY_SINK
+        policy, step = record['escalate'], record['unacked']['sent']
+        return PRIMARY_SINK if step < policy['times'] else policy['to'][step - policy['times']]
+
+    def _admit(self, key, record, now):
+        # Takes the tokens for delivering `key`, or holds it back: in the
+        # queue until they are there, or with its user's overflow.
+        user = record.get('user')
+        wait = self.limits.acquire(now, self._sink(key, record), user)
+        if wait is None:
+            return True
+        if self.limits.overflow == DIGEST and key > 0 and record.get('kind') != 'digest':
+            self._overflow.setdefault(user, [now + wait, []])[1].append(key)
+        else:
+            self.queue.push(key, now + wait)
+        return False
+
+    def _publish(self, kind, **data):
+        if self.store.events is not None:
+            self.store.events.publish(kind, **data)
+
+    def _wait(self, until, now):
+        waits = [self.poll_interval]
+        if until is not None:
+            waits.append(until - now)
+        if self._folds:
+            waits.append(min(end for _, end in self._folds) - now)
+        if self._overflow:
+            waits.append(min(retry for retry, _ in self._overflow.values()) - now)
+        return max(min(waits), 0)
+
+    def _collect(self, until, user, digest):
+        # One range query over the due index for what a digest (its
+        # members) or a folded quiet window (everything else) covers.
+        keys = []
+        for key, record in self.store.iter_due(until=until):
+            if (bool(record.get('digest')) != digest or record.get('kind') == 'digest' or record.get('done')
+                    or 'after' in record):
+                continue
+            # A quiet window for everyone folds every user's reminders.
+            if (digest or user is not None) and record.get('user') != user:
+                continue
+            keys.append(key)
+        return keys
+
+    def _send(self, send, title, message, kind, **data):
+        try:
+            send(title, message)
+        except Exception as e:
+            self._publish('failed', name=title, error=str(e), **data)
+            if self.store.events is None:
+                print(f'Delivering {title!r} failed: {e}', file=sys.stderr)
+        else:
+            self._publish(kind, name=title, **data)
+
+    def _send_digest(self, title, delivered, user, template=None):
+        title, message = render_digest(title, delivered, template)
+        self._send(self.deliver, title, message, 'digest', ids=[key for key, _ in delivered], user=user)
+
+    def _send_followup(self, key, record, step):
+        policy = record['escalate']
+        since = format_time(record['unacked']['since'], record.get('tz'))
+        message = f"{record['description']}\n(not acknowledged since {since})"
+        if step < policy['times']:
+            self._send(self.deliver, record['name'], message, 'renotified', id=key, step=step)
+        else:
+            sink = policy['to'][step - policy['times']]
+            self._send(get_sink(sink), record['name'], message, 'escalated', id=key, step=step, sink=sink)
+
+    def _deliver_fold(self, user, end, now):
+        # Everything of `user` (everyone for a global window) that came due
+        # up to the end of a quiet window, as one message.
+        with self.store.exclusive():
+            members = self._collect(end, user, digest=False)
+            if not members:
+                return
+            delivered = self.store.record_delivery_many(members, now)
+        if delivered:
+            self._send_digest('Quiet hours', delivered, user)
+
+    def _deliver_overflow(self, user, now):
+        entry = self._overflow[user]
+        wait = self.limits.acquire(now, PRIMARY_SINK, user)
+        if wait is not None:
+            entry[0] = now + wait
+            return
+        del self._overflow[user]
+        with self.store.exclusive():
+            # Reminders changed since then are back in the queue.
+            keys = [key for key in entry[1] if key in self.store and key not in self.queue and key not in self.ready
+                    and self.store.hot(key)[0] <= self.horizon]
+            if not keys:
+                return
+            delivered = self.store.record_delivery_many(keys, now)
+        if delivered:
+            self._send_digest('Held back', delivered, user)
+
+    def run_pending(self, now=None):
+        # Delivers everything that is due and returns the seconds until the
+        # next reminder (capped at poll_interval).
+        now = time.time() if now is None else now
+        self.quiet.refresh()
+        self.limits.refresh()
+        while True:
+            ended = [fold for fold in self._folds if fold[1] <= now]
+            if ended:
+                fold = min(ended, key=lambda fold: fold[1])
+                self._folds.discard(fold)
+                self._deliver_fold(fold[0], fold[1], now)
+                continue
+            retry = [user for user, entry in self._overflow.items() if entry[0] <= now]
+            if retry:
+                self._deliver_overflow(retry[0], now)
+                continue
+            shed = None
+            # Decided and committed with the store held against other
+            # processes, and only what was committed is sent afterwards.
+            with self.store.exclusive():
+                self._promote(now)
+                head = self.ready.peek()
+                if head is None:
+                    head = self._head()
+                    return self._wait(head[0] if head is not None else None, now)
+                (_, due), key = head
+                record = self.store.get(abs(key))
+                quiet = self.quiet.check(now, record.get('user'))
+                if quiet is not None:
+                    end, action, owner = quiet
+                    if action == DIGEST:
+                        self._folds.add((owner, end))
+                    if owner is None:
+                        # Quiet for everyone: nothing goes out until the
+                        # window ends, without touching any reminder.
+                        return self._wait(end, now)
+                    self.ready.remove(key)
+                    if not (action == DIGEST and key > 0 and record.get('kind') != 'digest'):
+                        self.queue.push(key, end)
+                    continue
+                if self._too_late(key, now):
+                    # Everything else this late goes in the same batch.
+                    late = sorted((queued for queued in self.ready if self._too_late(queued, now)),
+                                  key=lambda queued: self.ready.priority(queued)[1])
+                    for queued in late:
+                        self.ready.remove(queued)
+                    shed = self.store.record_delivery_many(late, now)
+                    if not shed:
+                        continue
+                else:
+                    self.ready.remove(key)
+                    if not self._admit(key, record, now):
+                        continue
+                    if key < 0:
+                        followup = self.store.record_followup(-key, now)
+                        if followup is None:
+                            continue
+                        record, step = followup
+                    else:
+                        members = []
+                        if record.get('kind') == 'digest':
+                            members = self._collect(now, record.get('user'), digest=True)
+                        delivered = self.store.record_delivery_many([key] + members, now)
+                        if not delivered or delivered[0][0] != key:
+                            continue
+                        record, delivered = delivered[0][1], delivered[1:]
+            if shed is not None:
+                if self.shed_action == DROP:
+                    self._publish('shed', ids=[queued for queued, _ in shed])
+                else:
+                    self._send_digest('Late reminders', shed, None)
+                continue
+            if key < 0:
+                self._send_followup(-key, record, step)
+                continue
+            if record.get('kind') == 'digest':
+                # An empty digest is not worth a notification.
+                if delivered:
+                    self._send_digest(record['name'], delivered, record.get('user'), record.get('template'))
+                continue
+            self._send(self.deliver, record['name'], record['description'], 'fired', id=key, due=record['due'])
+
+    def run(self):
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            delay = self.run_pending()
+            self._wakeup.wait(delay)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='reminder-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.close()
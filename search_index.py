@@ -0,0 +1,330 @@
+import heapq
+import math
+import mmap
+import os
+import re
+import struct
+from array import array
+from bisect import bisect_left
+
+TOKEN_RE = re.compile(r'\w+')
+NAME_WEIGHT = 3
+DESCRIPTION_WEIGHT = 1
+# Roughly how many distinct terms a reminder has, for choosing how to
+# intersect a query token with a set of candidates.
+TERMS_PER_DOCUMENT = 8
+
+# A segment file written by SearchIndex.save. It is memory-mapped when
+# loaded and nothing in it is decoded until a query reaches it.
+#
+#   header     MAGIC, term count T, document count D, posting count P
+#   terms      string starts (T + 1), posting starts (T + 1), in term order
+#   documents  ids (D), forward starts (D + 1), in id order
+#   postings   ids (P), then weights (P), each term's in id order
+#   forward    term numbers (P), then weights (P), each document's terms
+#   strings    the terms, UTF-8, back to back
+MAGIC = b'SIX1'
+HEADER = struct.Struct('<4s4xQQQ')
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+def document_terms(name, description):
+    terms = {}
+    for token in tokenize(name):
+        terms[token] = terms.get(token, 0) + NAME_WEIGHT
+    for token in tokenize(description):
+        terms[token] = terms.get(token, 0) + DESCRIPTION_WEIGHT
+    return terms
+
+
+class Segment:
+    # Read-only view of a segment file, memory-mapped.
+
+    def __init__(self, buf):
+        self._map = buf
+        self.buf = memoryview(buf)
+        _, terms, docs, postings = HEADER.unpack_from(self.buf)
+        offset = HEADER.size
+        sections = []
+        for code, count in (('Q', terms + 1), ('Q', terms + 1), ('q', docs), ('Q', docs + 1),
+                            ('q', postings), ('I', postings), ('I', postings), ('I', postings)):
+            size = count * array(code).itemsize
+            if offset + size > len(self.buf):
+                raise ValueError('truncated search segment')
+            sections.append(self.buf[offset:offset + size].cast(code))
+            offset += size
+        (self.string_starts, self.posting_starts, self.doc_keys, self.forward_starts,
+         self.posting_keys, self.posting_weights, self.forward_terms, self.forward_weights) = sections
+        self.strings = self.buf[offset:]
+        self.term_count = terms
+
+    def __len__(self):
+        return len(self.doc_keys)
+
+    def term(self, slot):
+        return str(self.strings[self.string_starts[slot]:self.string_starts[slot + 1]], 'utf-8')
+
+    def matching(self, token, prefix):
+        # Slots of the terms equal to `token`, or starting with it.
+        slot = bisect_left(range(self.term_count), token, key=self.term)
+        while slot < self.term_count:
+            term = self.term(slot)
+            if not (term == token or (prefix and term.startswith(token))):
+                break
+            yield slot, term
+            slot += 1
+
+    def count(self, slot):
+        return self.posting_starts[slot + 1] - self.posting_starts[slot]
+
+    def postings(self, slot):
+        start, end = self.posting_starts[slot], self.posting_starts[slot + 1]
+        return self.posting_keys[start:end], self.posting_weights[start:end]
+
+    def position(self, key):
+        i = bisect_left(self.doc_keys, key)
+        return i if i < len(self.doc_keys) and self.doc_keys[i] == key else None
+
+    def document(self, i):
+        # (term slot, weight) of the document at position `i`.
+        start, end = self.forward_starts[i], self.forward_starts[i + 1]
+        return zip(self.forward_terms[start:end], self.forward_weights[start:end])
+
+
+class SearchIndex:
+    # Postings of a saved segment (if any) with what was added or removed
+    # since kept on top, in memory: `postings` (term -> {key: weight}, its
+    # terms sorted for prefix lookups once a query needs them) and
+    # `doc_terms` (key -> {term: weight}) for the documents added since,
+    # `hidden` for the segment's documents removed or replaced since and
+    # `dropped` counting those by term slot, so document frequencies stay
+    # exact.
+
+    def __init__(self, segment=None):
+        self.segment = segment
+        self.postings = {}
+        self._terms = []
+        self.doc_terms = {}
+        self.hidden = set()
+        self.dropped = {}
+
+    @classmethod
+    def build(cls, documents):
+        index = cls()
+        for key, name, description in documents:
+            index.add(key, name, description)
+        return index
+
+    def __len__(self):
+        return len(self.doc_terms) + (len(self.segment) - len(self.hidden) if self.segment is not None else 0)
+
+    def add(self, key, name, description):
+        self.remove(key)
+        terms = document_terms(name, description)
+        for term, weight in terms.items():
+            docs = self.postings.get(term)
+            if docs is None:
+                docs = self.postings[term] = {}
+                self._terms = None
+            docs[key] = weight
+        self.doc_terms[key] = terms
+
+    def remove(self, key):
+        for term in self.doc_terms.pop(key, ()):
+            docs = self.postings[term]
+            del docs[key]
+            if not docs:
+                del self.postings[term]
+                self._terms = None
+        if self.segment is not None and key not in self.hidden:
+            i = self.segment.position(key)
+            if i is not None:
+                self.hidden.add(key)
+                for slot, _ in self.segment.document(i):
+                    self.dropped[slot] = self.dropped.get(slot, 0) + 1
+
+    def apply(self, changes):
+        # Changes as logged by the store: [id, name, description] for an
+        # added reminder, [id] for a removed one.
+        for change in changes:
+            if len(change) > 1:
+                self.add(*change)
+            else:
+                self.remove(change[0])
+
+    def _matching_terms(self, token, prefix):
+        # (term, segment slot or None, document count) of the terms that
+        # `token` matches and some document still has.
+        found = {}
+        if self.segment is not None:
+            for slot, term in self.segment.matching(token, prefix):
+                found[term] = slot
+        if prefix:
+            if self._terms is None:
+                self._terms = sorted(self.postings)
+            i = bisect_left(self._terms, token)
+            while i < len(self._terms) and self._terms[i].startswith(token):
+                found.setdefault(self._terms[i], None)
+                i += 1
+        elif token in self.postings:
+            found.setdefault(token, None)
+        matches = []
+        for term, slot in found.items():
+            count = len(self.postings.get(term, ()))
+            if slot is not None:
+                count += self.segment.count(slot) - self.dropped.get(slot, 0)
+            if count:
+                matches.append((term, slot, count))
+        return matches
+
+    def _docs(self, term, slot):
+        # key -> weight of everything that has `term`.
+        if slot is None:
+            return self.postings[term]
+        docs = dict(zip(*self.segment.postings(slot)))
+        if len(self.hidden) < len(docs):
+            for key in self.hidden:
+                docs.pop(key, None)
+        else:
+            docs = {key: weight for key, weight in docs.items() if key not in self.hidden}
+        docs.update(self.postings.get(term, ()))
+        return docs
+
+    def _idf(self, term, token, count, total):
+        idf = math.log(1 + total / count)
+        return idf if term == token else idf * 0.8
+
+    def _narrow(self, scores, token, terms, total):
+        # The candidates in `scores` that `token` matches too, with its score
+        # added: probing its postings, or reading the candidates' own terms
+        # when those are fewer lookups.
+        best = {}
+        probes = sum(min(count, len(scores)) for _, _, count in terms)
+        if probes > len(scores) * TERMS_PER_DOCUMENT:
+            idfs = {term: self._idf(term, token, count, total) for term, _, count in terms}
+            slots = {slot: idfs[term] for term, slot, _ in terms if slot is not None}
+            for key in scores:
+                if key in self.doc_terms:
+                    pairs = ((weight, idfs.get(term)) for term, weight in self.doc_terms[key].items())
+                else:
+                    pairs = ((weight, slots.get(slot))
+                             for slot, weight in self.segment.document(self.segment.position(key)))
+                for weight, idf in pairs:
+                    if idf is not None and weight * idf > best.get(key, 0):
+                        best[key] = weight * idf
+        else:
+            for term, slot, count in terms:
+                idf = self._idf(term, token, count, total)
+                docs = self._docs(term, slot)
+                if len(docs) < len(scores):
+                    pairs = ((key, weight) for key, weight in docs.items() if key in scores)
+                else:
+                    pairs = ((key, docs[key]) for key in scores if key in docs)
+                for key, weight in pairs:
+                    if weight * idf > best.get(key, 0):
+                        best[key] = weight * idf
+        return {key: scores[key] + score for key, score in best.items()}
+
+    def search(self, query, limit=20, prefix=True):
+        # Every query token has to match (as a prefix of) some term of the
+        # reminder; hits are ranked by weight * idf summed over the tokens.
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        total = max(len(self), 1)
+        matched = []
+        for token in tokens:
+            terms = self._matching_terms(token, prefix)
+            if not terms:
+                return []
+            matched.append((sum(count for _, _, count in terms), token, terms))
+        # Only the rarest token (by posting count) is scored from all its
+        # postings; the others are checked against the candidates left.
+        matched.sort(key=lambda item: item[0])
+        _, token, terms = matched[0]
+        scores = {}
+        for term, slot, count in terms:
+            idf = self._idf(term, token, count, total)
+            for key, weight in self._docs(term, slot).items():
+                score = weight * idf
+                if score > scores.get(key, 0):
+                    scores[key] = score
+        for _, token, terms in matched[1:]:
+            scores = self._narrow(scores, token, terms, total)
+            if not scores:
+                return []
+        if limit is None:
+            return sorted(scores.items(), key=lambda item: -item[1])
+        return heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+
+    def save(self, path):
+        # Everything, the segment's documents and those added since, as a
+        # new segment file at `path`.
+        old = self.segment
+        old_terms = [old.term(slot) for slot in range(old.term_count)] if old is not None else []
+        old_slots = {term: slot for slot, term in enumerate(old_terms)}
+        numbers = {}
+        string_starts, posting_starts = array('Q', [0]), array('Q', [0])
+        strings = bytearray()
+        keys, weights = array('q'), array('I')
+        for term in sorted(old_slots.keys() | self.postings.keys()):
+            slot = old_slots.get(term)
+            if slot is not None and not self.dropped.get(slot) and term not in self.postings:
+                # Untouched since the last save: copied as it is.
+                old_keys, old_weights = old.postings(slot)
+                keys.frombytes(old_keys.cast('B'))
+                weights.frombytes(old_weights.cast('B'))
+            else:
+                docs = self._docs(term, slot)
+                if not docs:
+                    continue
+                ordered = sorted(docs)
+                keys.extend(ordered)
+                weights.extend(map(docs.__getitem__, ordered))
+            numbers[term] = len(posting_starts) - 1
+            strings += term.encode()
+            string_starts.append(len(strings))
+            posting_starts.append(len(keys))
+        renumber = [numbers.get(term, 0) for term in old_terms]
+        doc_keys, forward_starts = array('q'), array('Q', [0])
+        forward_terms, forward_weights = array('I'), array('I')
+        kept = ()
+        if old is not None:
+            kept = ((key, i) for i, key in enumerate(old.doc_keys) if key not in self.hidden)
+        for key, i in heapq.merge(kept, ((key, None) for key in sorted(self.doc_terms))):
+            if i is None:
+                terms = self.doc_terms[key]
+                forward_terms.extend(map(numbers.__getitem__, terms))
+                forward_weights.extend(terms.values())
+            else:
+                start, end = old.forward_starts[i], old.forward_starts[i + 1]
+                forward_terms.extend(map(renumber.__getitem__, old.forward_terms[start:end]))
+                forward_weights.frombytes(old.forward_weights[start:end].cast('B'))
+            doc_keys.append(key)
+            forward_starts.append(len(forward_terms))
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(numbers), len(doc_keys), len(keys)))
+            for section in (string_starts, posting_starts, doc_keys, forward_starts,
+                            keys, weights, forward_terms, forward_weights):
+                f.write(section)
+            f.write(strings)
+
+    @classmethod
+    def load(cls, path):
+        # The index saved at `path`, or None when there is none.
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < HEADER.size:
+                    return None
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        if HEADER.unpack_from(buf)[0] != MAGIC:
+            return None
+        try:
+            return cls(Segment(buf))
+        except ValueError:
+            return None
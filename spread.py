@@ -0,0 +1,36 @@
+import collections
+
+from preview import format_time
+
+# Reminders due exactly on a multiple of this many seconds (every :00 and
+# :30) are the ones that pile up, so only those are spread out.
+ALIGN = 1800
+_MIX = 0x9E3779B97F4A7C15
+_MASK = (1 << 64) - 1
+
+
+def jitter(key, due, window, align=ALIGN):
+    # Seconds to hold back a reminder due on the grid: a fraction of
+    # `window` fixed by its id, so every process and restart agrees and a
+    # repeating reminder always lands on the same second. 0 off the grid.
+    if not window or due % align:
+        return 0.0
+    return ((key * _MIX) & _MASK) / (1 << 64) * window
+
+
+def histogram(items, window=0, align=ALIGN):
+    # Deliveries per second for (id, due) pairs, with `window` of spread.
+    return collections.Counter(int(due + jitter(key, due, window, align)) for key, due in items)
+
+
+def spread_report(items, window, align=ALIGN, top=10):
+    # Rows comparing the per-second load without and with spreading: a
+    # summary, then the busiest seconds as they were.
+    items = list(items)
+    before, after = histogram(items), histogram(items, window, align)
+    rows = [{'reminders': len(items), 'window': window,
+             'peak_before': max(before.values(), default=0), 'peak_after': max(after.values(), default=0),
+             'seconds_before': len(before), 'seconds_after': len(after)}]
+    for second, count in before.most_common(top):
+        rows.append({'second': format_time(second), 'before': count, 'after': after.get(second, 0)})
+    return rows
@@ -0,0 +1,949 @@
+import contextlib
+import fcntl
+import functools
+import json
+import math
+import os
+import threading
+import time
+from array import array
+
+from binary_index import BinaryIndex, LazyRecords, write_index
+from due_index import DueIndex
+from ids import IdGenerator
+from jsonstream import iter_object
+from notifier import get_sink
+from search_index import SearchIndex
+from timeparse import parse_duration, parse_schedule, parse_schedules
+from zones import find_zone, zone_table
+
+CACHE_PATH = 'cache.json'
+# The journal is folded into cache.json once it outgrows both this and the
+# snapshot itself, or once it changes more than COMPACT_MAX_CHANGED
+# reminders: those are kept decoded in memory until then.
+COMPACT_MIN_BYTES = 1 << 20
+COMPACT_MAX_CHANGED = 1 << 15
+# Name-keyed records of an old snapshot are given ids this many at a time.
+LEGACY_BATCH = 4096
+# The search log is folded into a new search segment once it outgrows both
+# this and a sixteenth of the segment.
+SEARCH_LOG_MIN_BYTES = 1 << 22
+
+
+class ReminderNotFound(KeyError):
+    pass
+
+
+class AmbiguousReminder(LookupError):
+    # A name that more than one reminder has; callers have to pick an id.
+    def __init__(self, name, ids):
+        super().__init__(name, ids)
+        self.name = name
+        self.ids = sorted(ids)
+
+
+HISTORY_LIMIT = 20
+# What a chained reminder can wait for on the reminder before it.
+CHAIN_EVENTS = ('fired', 'acked')
+# Most urgent first; records without a 'priority' are 'normal'.
+PRIORITIES = ('critical', 'high', 'normal', 'low')
+NORMAL = 'normal'
+
+
+def make_record(name, description='', due=None, delay=None, every=None, history=None, tz=None, wall=None,
+                user=None, digest=False, kind=None, template=None, escalate=None, unacked=None, done=False, after=None,
+                priority=None):
+    if due is None:
+        due = time.time() + number(delay or 0, 'delay')
+    record = {'name': str(name), 'due': number(due, 'due'), 'description': str(description)}
+    if every:
+        record['every'] = number(every, 'every')
+        # Anything else would never move the reminder past now.
+        if not math.isfinite(record['every']) or record['every'] <= 0:
+            raise ValueError(f'every has to be a positive number of seconds, not {every!r}')
+    if history:
+        if not isinstance(history, list):
+            raise ValueError(f'history has to be a list of times, not {history!r}')
+        record['history'] = [number(when, 'history') for when in history][-HISTORY_LIMIT:]
+    if tz:
+        # Reminders with a zone repeat on its wall clock; 'wall' is the
+        # intended local time of `due` as seconds since 1970-01-01 local,
+        # so an occurrence pushed through a DST gap doesn't shift the rest.
+        record['tz'] = find_zone(tz)
+        record['wall'] = float(wall if wall is not None else zone_table(record['tz']).to_wall(record['due']))
+    if user:
+        # Whose quiet hours and digest apply; unset means the global ones.
+        record['user'] = str(user)
+    if digest:
+        # Not delivered on its own but collected by the user's next digest.
+        record['digest'] = True
+    if kind is not None:
+        if kind != 'digest':
+            raise ValueError(f'unknown reminder kind {kind!r}')
+        # Gathers the digest reminders due by the time it fires.
+        record['kind'] = kind
+        if template:
+            record['template'] = str(template)
+    if escalate:
+        record['escalate'] = escalation(**options(escalate, 'escalate', ('every',), ('times', 'to')))
+    if unacked:
+        # Delivered and waiting for an ack: since when, and how many
+        # follow-ups have gone out.
+        record['unacked'] = {'since': float(unacked['since']), 'sent': int(unacked.get('sent', 0))}
+    if done:
+        # A one-shot reminder that only stays around until it is acked.
+        record['done'] = True
+    if after:
+        # Waits for another reminder to fire or be acked and is then due
+        # 'delay' seconds later; until then 'due' is only an estimate.
+        record['after'] = chain_link(**options(after, 'after', ('id',), ('on', 'delay')))
+    if priority and priority != NORMAL:
+        if priority not in PRIORITIES:
+            raise ValueError(f"unknown priority {priority!r}, use one of {', '.join(PRIORITIES)}")
+        record['priority'] = priority
+    return record
+
+
+OPTIONAL_FIELDS = ('every', 'history', 'tz', 'wall', 'user', 'digest', 'kind', 'template', 'escalate', 'unacked',
+                   'done', 'after', 'priority')
+
+
+# Bits of a record's flags in the binary index: what the scheduler needs
+# to know without decoding the record.
+FLAG_DIGEST = 1
+FLAG_DONE = 2
+FLAG_AFTER = 4
+FLAG_UNACKED = 8
+# Never due on its own.
+IDLE_FLAGS = FLAG_DIGEST | FLAG_DONE | FLAG_AFTER
+# Two bits above those for the index into PRIORITIES.
+PRIORITY_SHIFT = 4
+
+
+def record_flags(record):
+    return ((FLAG_DIGEST if record.get('digest') else 0) | (FLAG_DONE if record.get('done') else 0)
+            | (FLAG_AFTER if 'after' in record else 0) | (FLAG_UNACKED if 'unacked' in record else 0)
+            | PRIORITIES.index(record.get('priority', NORMAL)) << PRIORITY_SHIFT)
+
+
+def flags_priority(flags):
+    return PRIORITIES[flags >> PRIORITY_SHIFT & 3]
+
+
+def number(value, field):
+    try:
+        result = float(value)
+    except (TypeError, ValueError):
+        result = math.nan
+    # NaN and infinities aren't JSON and order nothing.
+    if not math.isfinite(result):
+        raise ValueError(f'{field} has to be a number, not {value!r}')
+    return result
+
+
+def options(value, field, required, optional=()):
+    # The keyword arguments a JSON object gives for `field`, checked
+    # against the ones it takes.
+    if not isinstance(value, dict):
+        raise ValueError(f'{field} has to be an object, not {value!r}')
+    missing = [key for key in required if key not in value]
+    unknown = [key for key in value if key not in required and key not in optional]
+    if missing or unknown:
+        raise ValueError(f"{field} needs {', '.join(required)} and can have {', '.join(optional)}, "
+                         f"not {value!r}")
+    return value
+
+
+def optional_fields(record):
+    return {key: record[key] for key in OPTIONAL_FIELDS if key in record}
+
+
+def escalation(every, times=0, to=()):
+    # Re-notify every `every` seconds, `times` times, then try each sink in
+    # `to` in turn, one interval apart, until the reminder is acked.
+    to = [to] if isinstance(to, str) else to
+    if not isinstance(to, (list, tuple)) or not all(isinstance(sink, str) for sink in to):
+        raise ValueError(f'escalate to has to be a sink or a list of them, not {to!r}')
+    to = list(to)
+    for sink in to:
+        get_sink(sink)
+    every, times = number(every, 'escalate every'), int(number(times, 'escalate times'))
+    if every <= 0 or times < 0 or not (times or to):
+        raise ValueError('an escalation needs a positive interval and at least one follow-up')
+    return {'every': every, 'times': times, 'to': to}
+
+
+def chain_link(id, on='fired', delay=0):
+    if on not in CHAIN_EVENTS:
+        raise ValueError(f"a chain waits for one of {', '.join(CHAIN_EVENTS)}, not {on!r}")
+    delay = parse_duration(delay)
+    if delay < 0:
+        raise ValueError('a chain delay cannot be negative')
+    return {'id': reminder_id(id), 'on': on, 'delay': delay}
+
+
+def next_followup(record):
+    pending, policy = record['unacked'], record['escalate']
+    return pending['since'] + (pending['sent'] + 1) * policy['every']
+
+
+def with_due(record, due):
+    record = dict(record, due=float(due))
+    if 'tz' in record:
+        record['wall'] = float(zone_table(record['tz']).to_wall(record['due']))
+    return record
+
+
+def advance(record, steps):
+    # The record moved `steps` repeats on.
+    offset = steps * record['every']
+    if 'tz' not in record:
+        return dict(record, due=record['due'] + offset)
+    wall = record['wall'] + offset
+    return dict(record, due=float(zone_table(record['tz']).to_utc(wall)), wall=wall)
+
+
+def normalize_record(record, base_time):
+    # Older cache files only stored 'time', the delay in seconds from when the
+    # reminder was written, so anchor it on the file's modification time.
+    due = record['due'] if 'due' in record else base_time + number(record.get('time', 0), 'time')
+    return make_record(record['name'], record.get('description', ''), due=due, **optional_fields(record))
+
+
+def record_from_input(item, now=None):
+    # Accepts the shapes used by `add` on stdin and by `import`:
+    # {"name": ..., "description": ..., "due": epoch} or {..., "time": when},
+    # where `when` is a delay in seconds or an expression like "tomorrow 9am"
+    # or "every day 09:00 Europe/Berlin", optionally with "every" (seconds
+    # between repeats), "tz" (IANA zone the time is read in), "priority"
+    # and "after" ({"id": ..., "on": "fired" or "acked", "delay": "30 min"}).
+    if not isinstance(item, dict):
+        raise ValueError('expected a reminder object, not %r' % (item,))
+    if 'name' not in item:
+        raise ValueError('reminder is missing a name: %r' % (item,))
+    now = time.time() if now is None else now
+    every, tz = item.get('every'), item.get('tz')
+    if 'due' in item:
+        due = item['due']
+    else:
+        due, repeat, tz = parse_schedule(item.get('time', 0), now, tz)
+        every = every or repeat
+    return make_record(item['name'], item.get('description', ''), due=due, every=every,
+                       history=item.get('history'), tz=tz, user=item.get('user'), digest=item.get('digest'),
+                       kind=item.get('kind'), template=item.get('template'), escalate=item.get('escalate'),
+                       after=item.get('after'), priority=item.get('priority'))
+
+
+def records_from_input(items, now=None):
+    # Bulk form for imports: every relative time is parsed against one clock.
+    items = list(items)
+    for item in items:
+        if not isinstance(item, dict):
+            raise ValueError('expected a reminder object, not %r' % (item,))
+    now = time.time() if now is None else now
+    relative = [item for item in items if 'due' not in item]
+    schedules = iter(parse_schedules([item.get('time', 0) for item in relative], now,
+                                     [item.get('tz') for item in relative]))
+    records = []
+    for item in items:
+        if 'due' not in item:
+            due, every, tz = next(schedules)
+            item = dict(item, due=due, every=item.get('every') or every, tz=tz)
+        records.append(record_from_input(item, now))
+    return records
+
+
+def search_changes(ops):
+    # What of a batch the search index has to know, as SearchIndex.apply
+    # takes it: puts carrying an event only change a reminder's state, so
+    # those left add reminders.
+    return [[op['id'], op['record']['name'], op['record']['description']] if op['op'] == 'put' else [op['id']]
+            for op in ops if op['op'] == 'del' or 'event' not in op]
+
+
+def reminder_id(value):
+    # Ids come as ints or, from JSON clients, as digit strings; a float has
+    # already lost digits.
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    raise ValueError(f'expected a reminder id, not {value!r}')
+
+
+def to_row(key, record):
+    # Ids go out as strings: they are above 2**53, where JSON numbers stop
+    # being exact for JavaScript and other double-based clients.
+    row = {'id': str(key), **record}
+    if 'after' in record:
+        row['after'] = dict(record['after'], id=str(record['after']['id']))
+    return row
+
+
+def occurrences(record, count):
+    if not record.get('every'):
+        return [record['due']]
+    if 'tz' in record:
+        table = zone_table(record['tz'])
+        return [table.to_utc(record['wall'] + i * record['every']) for i in range(count)]
+    return [record['due'] + i * record['every'] for i in range(count)]
+
+
+def locked(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class ReminderStore:
+    # cache.json holds a snapshot; every change since then is appended to a
+    # journal next to it, one line per committed batch. Readers replay the
+    # journal on load, and long-running processes pick up batches written
+    # by other processes by replaying just the new tail.
+    #
+    # Reminders are keyed by a 64-bit id (see ids.py); names are only an
+    # index and several reminders may share one.
+
+    def __init__(self, path=CACHE_PATH, events=None):
+        self.path = path
+        self.events = events
+        base = os.path.splitext(path)[0]
+        self.search_path = base + '.search'
+        self.search_log_path = base + '.search.log'
+        self.journal_path = base + '.journal'
+        self.lock_path = base + '.lock'
+        self.index_path = base + '.index'
+        self.quiet_path = base + '.quiet.json'
+        self.limits_path = base + '.limits.json'
+        self.ids = IdGenerator(base + '.ids')
+        self.reminders = {}
+        self._names = None
+        # id -> ids of the reminders waiting on it (their 'after').
+        self.dependents = {}
+        # Ids of the reminders waiting for an ack.
+        self.unacked = set()
+        self._max_id = 0
+        self._file_locked = False
+        self.due_index = DueIndex()
+        self._search_index = None
+        self._search_log_read = None
+        self.generation = 0
+        self._versions = {}
+        # Callables told about every applied change as (id, record), with
+        # record None for a removal, and (None, None) after a full reload.
+        self.observers = []
+        # Held by whoever reads or changes the store while a scheduler
+        # thread is delivering from it.
+        self.lock = threading.RLock()
+        self.load()
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        # Serializes journal appends and compaction between processes.
+        with self.lock:
+            if self._file_locked:
+                yield
+                return
+            with open(self.lock_path, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                self._file_locked = True
+                try:
+                    yield
+                finally:
+                    self._file_locked = False
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        # The store brought up to date and held against other processes and
+        # threads: what is read inside can be committed on without anyone
+        # changing it in between. Schedulers decide what to deliver under
+        # this, so two processes never both send the same reminder.
+        with self._file_lock():
+            self.refresh()
+            yield
+
+    def _snapshot_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return [st.st_ino, st.st_mtime_ns, st.st_size]
+
+    @locked
+    def load(self):
+        self.snapshot_stamp = self._snapshot_stamp()
+        # A snapshot written by _compact has a binary index next to it and
+        # is only mapped, not parsed: records are decoded as they are read.
+        index = None
+        if self.snapshot_stamp is not None:
+            index = BinaryIndex.open(self.index_path, self.path, self.snapshot_stamp)
+            if index is None:
+                index = self._convert_snapshot()
+        self.reminders = LazyRecords(index, record_flags)
+        self._max_id = self.reminders.max_key()
+        self._names = None
+        self.dependents = {}
+        self.unacked = set()
+        for key, _, flags in self.reminders.hot():
+            if flags & FLAG_AFTER:
+                self.dependents.setdefault(self.reminders[key]['after']['id'], set()).add(key)
+            if flags & FLAG_UNACKED:
+                self.unacked.add(key)
+        self.due_index.reset(index)
+        self._search_index = None
+        self.generation += 1
+        self._versions = {}
+        self.revision = 0
+        self.journal_offset = 0
+        self._replay_journal(publish=False)
+        self._notify(None, None)
+        self._publish('reloaded', count=len(self.reminders))
+
+    def _convert_snapshot(self):
+        # Rewrites a snapshot that has no binary index (an older one, or a
+        # name-keyed one from before ids) with one, reading it entry by
+        # entry so it never has to fit in memory whole. Whoever gets the
+        # lock first does it; the others find the index it wrote.
+        with self._file_lock():
+            self.snapshot_stamp = self._snapshot_stamp()
+            if self.snapshot_stamp is None:
+                return None
+            index = BinaryIndex.open(self.index_path, self.path, self.snapshot_stamp)
+            if index is None:
+                self._write_snapshot((key, rec['due'], record_flags(rec), json.dumps(rec).encode())
+                                     for key, rec in self._read_snapshot())
+                index = BinaryIndex.open(self.index_path, self.path, self.snapshot_stamp)
+            return index
+
+    def _read_snapshot(self):
+        # (id, record) for each entry of cache.json, in file order. Entries
+        # keyed by name get ids in batches, above the largest id read so far.
+        base_time = os.path.getmtime(self.path)
+        top = 0
+        legacy = []
+        with open(self.path, encoding='utf-8') as f:
+            for key, rec in iter_object(f):
+                if 'name' in rec:
+                    top = max(top, int(key))
+                    yield int(key), normalize_record(rec, base_time)
+                    continue
+                legacy.append(normalize_record(dict(rec, name=key), base_time))
+                if len(legacy) >= LEGACY_BATCH:
+                    yield from zip(self.ids.allocate(len(legacy), top + 1), legacy)
+                    legacy = []
+        if legacy:
+            yield from zip(self.ids.allocate(len(legacy), top + 1), legacy)
+
+    def _replay_journal(self, publish=True):
+        try:
+            with open(self.journal_path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < self.journal_offset:
+                    # Another process compacted after we read the snapshot.
+                    self.load()
+                    return 1
+                f.seek(self.journal_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        applied = 0
+        for line in data.splitlines(keepends=True):
+            # A line without its newline is a batch still being (or never
+            # completely) written; it is picked up on a later replay.
+            if not line.endswith(b'\n'):
+                break
+            self.journal_offset += len(line)
+            self._apply(json.loads(line)['ops'], publish)
+            applied += 1
+        return applied
+
+    @locked
+    def refresh(self):
+        # Picks up changes made by other processes: a new snapshot means a
+        # full reload, journal growth only replays the new batches.
+        if self._snapshot_stamp() != self.snapshot_stamp:
+            self.load()
+            return True
+        return self._replay_journal() > 0
+
+    @property
+    def names(self):
+        # name -> ids. Built on first use, since it needs every record's
+        # name and a start from the binary index doesn't read those.
+        with self.lock:
+            if self._names is None:
+                names = {}
+                for key, rec in self.reminders.items():
+                    names.setdefault(rec['name'], set()).add(key)
+                self._names = names
+            return self._names
+
+    def hot_items(self):
+        # (id, due, flags) of every reminder; see record_flags.
+        return self.reminders.hot()
+
+    def hot(self, key):
+        # (due, flags) of one reminder, without reading the rest of it.
+        try:
+            return self.reminders.hot_entry(key)
+        except KeyError:
+            raise ReminderNotFound(key) from None
+
+    def _apply(self, ops, publish=True):
+        for op in ops:
+            key = op['id']
+            old = self.reminders.get(key)
+            if (self._names is not None and old is not None
+                    and (op['op'] != 'put' or old['name'] != op['record']['name'])):
+                ids = self._names[old['name']]
+                ids.discard(key)
+                if not ids:
+                    del self._names[old['name']]
+            if old is not None and 'after' in old:
+                waiting = self.dependents.get(old['after']['id'])
+                if waiting is not None:
+                    waiting.discard(key)
+                    if not waiting:
+                        del self.dependents[old['after']['id']]
+            if op['op'] == 'put':
+                record = op['record']
+                self.reminders[key] = record
+                if self._names is not None:
+                    self._names.setdefault(record['name'], set()).add(key)
+                if 'after' in record:
+                    self.dependents.setdefault(record['after']['id'], set()).add(key)
+                if 'unacked' in record:
+                    self.unacked.add(key)
+                else:
+                    self.unacked.discard(key)
+                if key > self._max_id:
+                    self._max_id = key
+                self.due_index.add(key, record['due'])
+                if self._search_index is not None and 'event' not in op:
+                    self._search_index.add(key, record['name'], record['description'])
+            else:
+                if old is None:
+                    continue
+                del self.reminders[key]
+                self.unacked.discard(key)
+                self.due_index.remove(key)
+                if self._search_index is not None:
+                    self._search_index.remove(key)
+            self._touch(key)
+            self._notify(key, self.reminders.get(key))
+            if publish:
+                if op['op'] == 'put':
+                    self._publish(op.get('event', 'added'), id=key, name=record['name'], due=record['due'],
+                                  description=record['description'])
+                else:
+                    self._publish(op.get('event', 'removed'), id=key, name=old['name'])
+        self.revision += 1
+
+    def _commit(self, ops):
+        # One journal line per batch, so a batch is either replayed whole
+        # or (if the write was torn) not at all.
+        with self._file_lock():
+            self.refresh()
+            line = json.dumps({'ops': ops}).encode() + b'\n'
+            fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.journal_offset += len(line)
+            self._log_search_changes(search_changes(ops))
+            self._apply(ops)
+            if (self.journal_offset > max(COMPACT_MIN_BYTES, (self.snapshot_stamp or [0, 0, 0])[2])
+                    or len(self.reminders.changed) > COMPACT_MAX_CHANGED):
+                self._compact()
+
+    def compact(self):
+        with self._file_lock():
+            self.refresh()
+            self._compact()
+
+    def _compact(self):
+        # A new snapshot of everything, then an empty journal. Records still
+        # in the old snapshot are copied over without decoding them.
+        self._write_snapshot(self.reminders.raw_items())
+        with open(self.journal_path, 'w'):
+            pass
+        self.journal_offset = 0
+        # Everything is in the new snapshot, so read from that rather than
+        # keep the changes made since the last one.
+        index = BinaryIndex.open(self.index_path, self.path, self.snapshot_stamp)
+        if index is not None:
+            self.reminders = LazyRecords(index, record_flags)
+            self.due_index.reset(index)
+        if self._search_log_due():
+            # Otherwise only searches fold it, and a store that is no longer
+            # searched would keep logging.
+            if self._search_index is None:
+                self._search_index = self._open_search_index()
+            self._search_index = self._save_search_index(self._search_index, self._search_log_read)
+
+    def _write_snapshot(self, entries):
+        # Writes (id, due, flags, JSON bytes) entries as cache.json, through
+        # a sibling file and a rename so a crash never leaves a truncated
+        # one behind, and where each one lands as the binary index.
+        tmp_path = self.path + '.tmp'
+        keys, dues, flags, offsets, lengths = array('q'), array('d'), array('I'), array('Q'), array('I')
+        with open(tmp_path, 'wb') as f:
+            f.write(b'{')
+            position = 1
+            for key, due, flag, raw in entries:
+                prefix = b'%s"%d": ' % (b', ' if keys else b'', key)
+                f.write(prefix)
+                f.write(raw)
+                keys.append(key)
+                dues.append(due)
+                flags.append(flag)
+                offsets.append(position + len(prefix))
+                lengths.append(len(raw))
+                position += len(prefix) + len(raw)
+            f.write(b'}')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.snapshot_stamp = self._snapshot_stamp()
+        write_index(self.index_path, self.snapshot_stamp, keys, dues, flags, offsets, lengths)
+
+    def _log_search_changes(self, changes):
+        # Once there is a search log, every batch appends what it changes
+        # for search to it, whether or not this process has the index open.
+        if not changes:
+            return
+        try:
+            fd = os.open(self.search_log_path, os.O_WRONLY | os.O_APPEND)
+        except FileNotFoundError:
+            return
+        try:
+            os.write(fd, json.dumps(changes).encode() + b'\n')
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _read_search_log(self, index, since=None):
+        # Applies the search log to `index`, past `since` if that is where
+        # an earlier call stopped in the same log; returns (inode, offset)
+        # of where this one stopped.
+        with open(self.search_log_path, 'rb') as f:
+            ino = os.fstat(f.fileno()).st_ino
+            offset = since[1] if since is not None and since[0] == ino else 0
+            f.seek(offset)
+            data = f.read()
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            index.apply(json.loads(line))
+        return ino, offset
+
+    def _search_log_due(self):
+        try:
+            size = os.path.getsize(self.search_log_path)
+            return size > max(SEARCH_LOG_MIN_BYTES, os.path.getsize(self.search_path) // 16)
+        except FileNotFoundError:
+            return False
+
+    def _open_search_index(self):
+        # The saved segment and the log on top of it. The first time, the
+        # log is started before the store is read, so what is read plus the
+        # log is current from then on, and the index is built and saved.
+        with self._file_lock():
+            self.refresh()
+            if os.path.exists(self.search_log_path):
+                index = SearchIndex.load(self.search_path)
+                if index is not None:
+                    self._search_log_read = self._read_search_log(index)
+                    return index
+            open(self.search_log_path, 'ab').close()
+        index = SearchIndex.build((key, rec['name'], rec['description']) for key, rec in self.reminders.items())
+        return self._save_search_index(index)
+
+    def _save_search_index(self, index, since=None):
+        # Folds `index` and the log (past `since`) into a new segment,
+        # written outside the file lock; what is logged meanwhile stays in
+        # the log.
+        with self._file_lock():
+            self.refresh()
+            ino, folded = self._read_search_log(index, since)
+        tmp_path = f'{self.search_path}.{os.getpid()}.tmp'
+        index.save(tmp_path)
+        with self._file_lock():
+            if os.stat(self.search_log_path).st_ino != ino:
+                # Another process folded the log first; use its segment.
+                os.unlink(tmp_path)
+            else:
+                os.replace(tmp_path, self.search_path)
+                with open(self.search_log_path, 'rb') as f:
+                    f.seek(folded)
+                    rest = f.read()
+                with open(self.search_log_path + '.tmp', 'wb') as f:
+                    f.write(rest)
+                os.replace(self.search_log_path + '.tmp', self.search_log_path)
+            saved = SearchIndex.load(self.search_path)
+            self._search_log_read = self._read_search_log(saved)
+        return saved
+
+    @property
+    def search_index(self):
+        # Opened on first use and kept up to date by _apply from then on;
+        # folded into a new segment whenever the log has grown enough.
+        with self.lock:
+            if self._search_index is None:
+                self._search_index = self._open_search_index()
+            if self._search_log_due():
+                self._search_index = self._save_search_index(self._search_index, self._search_log_read)
+            return self._search_index
+
+    @locked
+    def search(self, query, limit=20):
+        # The index may already have changes logged by other processes that
+        # this one has yet to read from the journal.
+        return [(key, self.reminders[key], score) for key, score in self.search_index.search(query, limit)
+                if key in self.reminders]
+
+    def get(self, key):
+        try:
+            return self.reminders[key]
+        except KeyError:
+            raise ReminderNotFound(key) from None
+
+    def find(self, name):
+        # Ids of the reminders called `name`, oldest first.
+        return sorted(self.names.get(name, ()))
+
+    def resolve(self, ref):
+        # An id (int or digit string) or a name that exactly one reminder has.
+        if isinstance(ref, int) or (isinstance(ref, str) and ref.isdigit()):
+            if int(ref) in self.reminders:
+                return int(ref)
+        ids = self.names.get(str(ref), ())
+        if len(ids) > 1:
+            raise AmbiguousReminder(str(ref), ids)
+        if not ids:
+            raise ReminderNotFound(ref)
+        return next(iter(ids))
+
+    def resolve_many(self, refs):
+        return [self.resolve(ref) for ref in refs]
+
+    def items(self):
+        return self.reminders.items()
+
+    def __len__(self):
+        return len(self.reminders)
+
+    def __contains__(self, key):
+        return key in self.reminders
+
+    def version(self, key):
+        # Changes whenever the reminder does, for caches keyed on its content.
+        return self.generation, self._versions.get(key, 0)
+
+    def _notify(self, key, record):
+        for observer in self.observers:
+            observer(key, record)
+
+    def _publish(self, kind, **data):
+        if self.events is not None:
+            self.events.publish(kind, **data)
+
+    def _touch(self, key):
+        self._versions[key] = self._versions.get(key, 0) + 1
+
+    def iter_due(self, since=None, until=None, offset=0, limit=None):
+        for _, key in self.due_index.range(since, until, offset, limit):
+            yield key, self.reminders[key]
+
+    def next_due(self, k=1, after=None):
+        return [(key, self.reminders[key]) for _, key in self.due_index.next_due(k, after)]
+
+    def _chained(self, key, record):
+        # `record` with its estimated due time, once its 'after' is known to
+        # name a reminder that can satisfy it without closing a loop. Every
+        # reminder waits on at most one other, so this walks one path.
+        link = record['after']
+        upstream = self.get(link['id'])
+        if link['on'] == 'acked' and not upstream.get('escalate'):
+            raise ValueError(f"{upstream['name']!r} ({link['id']}) is never acked, it has no escalation")
+        node = link['id']
+        while node is not None:
+            if node == key:
+                raise ValueError(f'chaining {key} after {link["id"]} would make a cycle')
+            parent = self.reminders.get(node, {}).get('after')
+            node = parent['id'] if parent else None
+        return with_due(record, upstream['due'] + link['delay'])
+
+    def _triggered(self, keys, on, when):
+        # Put ops releasing the reminders that wait for `on` of one of
+        # `keys`. Only their direct dependents are looked at.
+        ops = []
+        for key in keys:
+            for dependent in sorted(self.dependents.get(key, ())):
+                record = self.reminders[dependent]
+                link = record['after']
+                if link['on'] != on:
+                    continue
+                record = with_due({field: value for field, value in record.items() if field != 'after'},
+                                  when + link['delay'])
+                ops.append({'op': 'put', 'id': dependent, 'record': record, 'event': 'triggered'})
+        return ops
+
+    def _with_dependents(self, keys):
+        # `keys` and every reminder still waiting on one of them, down the
+        # chains: those can't come due once what they wait for is gone.
+        keys = list(dict.fromkeys(keys))
+        seen = set(keys)
+        for key in keys:
+            for dependent in sorted(self.dependents.get(key, ())):
+                if dependent not in seen:
+                    seen.add(dependent)
+                    keys.append(dependent)
+        return keys
+
+    def add(self, record):
+        return self.add_many([record])[0]
+
+    @locked
+    def add_many(self, records):
+        # All reminders of one call are committed as a single journal batch.
+        # Returns (id, record) pairs.
+        records = [self._chained(None, record) if 'after' in record else record for record in records]
+        items = list(zip(self.ids.allocate(len(records), self._max_id + 1), records))
+        self._commit([{'op': 'put', 'id': key, 'record': record} for key, record in items])
+        return items
+
+    def remove(self, key):
+        return self.remove_many([key])[0]
+
+    @locked
+    def remove_many(self, keys):
+        # Reminders chained after a removed one go with it.
+        keys = self._with_dependents(keys)
+        removed = [(key, self.get(key)) for key in keys]
+        self._commit([{'op': 'del', 'id': key} for key in keys])
+        return removed
+
+    def snooze(self, key, delta):
+        return self.snooze_many([key], delta)[0][1]
+
+    @locked
+    def snooze_many(self, keys, delta):
+        # One journal record for the whole batch; each reminder only moves
+        # its own position in the due index and the scheduler heap.
+        keys = list(dict.fromkeys(keys))
+        snoozed = [(key, with_due(self.get(key), self.get(key)['due'] + float(delta))) for key in keys]
+        self._commit([{'op': 'put', 'id': key, 'record': record, 'event': 'snoozed'} for key, record in snoozed])
+        return snoozed
+
+    @locked
+    def reschedule(self, key, when):
+        # A fixed time also ends waiting on a chain.
+        record = with_due({field: value for field, value in self.get(key).items() if field != 'after'}, when)
+        self._commit([{'op': 'put', 'id': key, 'record': record, 'event': 'rescheduled'}])
+        return record
+
+    @locked
+    def chain(self, key, after):
+        # Makes reminder `key` wait for another, as in make_record's `after`.
+        record = self._chained(key, dict(self.get(key), after=chain_link(**after)))
+        self._commit([{'op': 'put', 'id': key, 'record': record, 'event': 'chained'}])
+        return record
+
+    def record_delivery(self, key, when):
+        delivered = self.record_delivery_many([key], when)
+        return delivered[0] if delivered else None
+
+    def _deliverable(self, key, when):
+        if key not in self.reminders:
+            return False
+        due, flags = self.reminders.hot_entry(key)
+        return due <= when and not flags & (FLAG_DONE | FLAG_AFTER)
+
+    @locked
+    def record_delivery_many(self, keys, when):
+        # Repeating reminders move on to their next occurrence after `when`
+        # and keep a short delivery history; one-shot reminders are dropped,
+        # unless they escalate and so have to wait for an ack. Reminders
+        # chained after them are released in the same batch.
+        # Returns (id, record) pairs with the record as it was delivered.
+        # Whatever another process has delivered, removed or moved on since
+        # the caller looked is left out: only what is returned was committed.
+        with self._file_lock():
+            self.refresh()
+            keys = [key for key in dict.fromkeys(keys) if self._deliverable(key, when)]
+            delivered = [(key, self.get(key)) for key in keys]
+            ops = self._triggered(keys, 'fired', when)
+            for key, record in delivered:
+                every = record.get('every')
+                if record.get('escalate'):
+                    record = dict(record, unacked={'since': when, 'sent': 0})
+                    if not every:
+                        ops.append({'op': 'put', 'id': key, 'record': dict(record, done=True), 'event': 'unacked'})
+                        continue
+                elif not every:
+                    ops.append({'op': 'del', 'id': key})
+                    continue
+                record = dict(record, history=(record.get('history', []) + [when])[-HISTORY_LIMIT:])
+                if record['due'] <= when:
+                    record = advance(record, math.floor((when - record['due']) / every) + 1)
+                # Wall-clock repeats can still be short by a DST shift.
+                while record['due'] <= when:
+                    record = advance(record, 1)
+                ops.append({'op': 'put', 'id': key, 'record': record, 'event': 'rescheduled'})
+            if ops:
+                self._commit(ops)
+        return delivered
+
+    @locked
+    def record_followup(self, key, when=None):
+        # Counts one follow-up of an unacked reminder. Returns the record as
+        # it was and the step: below escalate['times'] a re-notify, after
+        # that an index into escalate['to'] offset by 'times'. Once the last
+        # step is out the reminder stops waiting (and a one-shot one goes).
+        # Returns None if it was acked, or the follow-up not yet due at
+        # `when`, by the time the lock was held.
+        with self._file_lock():
+            self.refresh()
+            record = self.reminders.get(key)
+            if record is None or 'unacked' not in record or (when is not None and next_followup(record) > when):
+                return None
+            pending, policy = record['unacked'], record['escalate']
+            step = pending['sent']
+            if step + 1 >= policy['times'] + len(policy['to']):
+                if record.get('done'):
+                    # Never acked, so whatever waits for its ack goes too.
+                    self._commit([{'op': 'del', 'id': key} for key in self._with_dependents([key])])
+                else:
+                    updated = {field: value for field, value in record.items() if field != 'unacked'}
+                    self._commit([{'op': 'put', 'id': key, 'record': updated, 'event': 'followed_up'}])
+            else:
+                updated = dict(record, unacked=dict(pending, sent=step + 1))
+                self._commit([{'op': 'put', 'id': key, 'record': updated, 'event': 'followed_up'}])
+        return record, step
+
+    def ack(self, key, when=None):
+        return self.ack_many([key], when)[0]
+
+    @locked
+    def ack_many(self, keys, when=None):
+        when = time.time() if when is None else when
+        keys = list(dict.fromkeys(keys))
+        acked = [(key, self.get(key)) for key in keys]
+        for key, record in acked:
+            if 'unacked' not in record:
+                raise ValueError(f"{record['name']!r} ({key}) is not waiting for an acknowledgement")
+        ops = self._triggered(keys, 'acked', when)
+        for key, record in acked:
+            if record.get('done'):
+                ops.append({'op': 'del', 'id': key, 'event': 'acked'})
+            else:
+                updated = {field: value for field, value in record.items() if field != 'unacked'}
+                ops.append({'op': 'put', 'id': key, 'record': updated, 'event': 'acked'})
+        self._commit(ops)
+        return acked
@@ -0,0 +1,114 @@
+import curses
+import functools
+import os
+import sys
+import termios
+
+from simple_term_menu import MIN_VISIBLE_MENU_ENTRIES_COUNT, TerminalMenu
+
+
+@functools.lru_cache(maxsize=None)
+def _tty_fd():
+    try:
+        return os.open('/dev/tty', os.O_RDWR | os.O_NOCTTY)
+    except OSError:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def _terminfo_loaded():
+    # Load the terminfo entry for $TERM once, in-process, instead of asking
+    # tput for each capability.
+    fd = _tty_fd()
+    try:
+        curses.setupterm(os.environ.get('TERM'), sys.__stdout__.fileno() if fd is None else fd)
+    except (curses.error, AttributeError, ValueError, OSError):
+        return False
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def capability(capname):
+    # Same results as `tput <capname>`, e.g. capability('setaf 1') or
+    # capability('colors'); unknown or missing capabilities give ''.
+    if not _terminfo_loaded():
+        return ''
+    name, *params = capname.split()
+    number = curses.tigetnum(name)
+    if number != -2:
+        return str(number)
+    value = curses.tigetstr(name)
+    if value is None:
+        return ''
+    if params:
+        value = curses.tparm(value, *map(int, params))
+    return value.decode('latin-1')
+
+
+def terminal_size():
+    # A single ioctl on the controlling terminal; falls back to 80x24.
+    for fd in (_tty_fd(), getattr(sys.__stdout__, 'fileno', lambda: None)()):
+        if fd is None:
+            continue
+        try:
+            return os.get_terminal_size(fd)
+        except OSError:
+            continue
+    return os.terminal_size((80, 24))
+
+
+class Menu(TerminalMenu):
+    # simple_term_menu forks `tput` for every capability, again for the
+    # terminal size on each repaint, and `stty -a` for every menu it builds.
+
+    class Viewport(TerminalMenu.Viewport):
+        # The stock viewport asks TerminalMenu._num_lines (i.e. tput) directly.
+
+        def _calculate_num_lines(self):
+            return (
+                terminal_size().lines
+                - self._title_lines_count
+                - self._status_bar_lines_count
+                - self._preview_lines_count
+                - self._search_lines_count
+            )
+
+        @property
+        def preview_lines_count(self):
+            return self._preview_lines_count
+
+        @preview_lines_count.setter
+        def preview_lines_count(self, value):
+            self._preview_lines_count = min(
+                value if value >= 3 else 0,
+                terminal_size().lines
+                - self._title_lines_count
+                - self._status_bar_lines_count
+                - MIN_VISIBLE_MENU_ENTRIES_COUNT,
+            )
+
+    @classmethod
+    def _query_terminfo_database(cls, codename):
+        return capability(cls._codename_to_capname.get(codename, codename))
+
+    @classmethod
+    def _num_lines(cls):
+        return terminal_size().lines
+
+    @classmethod
+    def _num_cols(cls):
+        return terminal_size().columns
+
+    @classmethod
+    def _init_backspace_control_character(cls):
+        fd = _tty_fd()
+        erase = None
+        if fd is not None:
+            try:
+                erase = termios.tcgetattr(fd)[6][termios.VERASE]
+            except termios.error:
+                pass
+        if isinstance(erase, bytes) and erase not in (b'', b'\x00'):
+            cls._name_to_control_character['backspace'] = erase.decode('latin-1')
+        else:
+            cls._name_to_control_character['backspace'] = '\177'
@@ -0,0 +1,416 @@
+import datetime
+import functools
+import math
+import re
+import time
+
+from zones import find_zone, local_to_utc, zone_table
+
+# Accepted forms, case-insensitive:
+#   300                       seconds from now (what the menu used to take)
+#   in 20 minutes, in 1h30m, 2 hours and 15 min, 3 days from now
+#   now, tomorrow, today 18:00, tomorrow 9am, at noon, 14:30
+#   friday, next Friday 14:30, mon 8:15pm
+#   2026-10-20, 2026-10-20 14:30, 2026-10-20T14:30
+#   every day 09:00 Europe/Berlin, every 2 hours, every monday 9am
+#
+#   expr     := (NUMBER END | 'now' | ['in'] duration ['from' 'now' | 'later']
+#               | repeat | [day] ['at'] [clock]) [ZONE]
+#   repeat   := 'every' (duration | UNIT | WEEKDAY) ['at'] [clock]
+#   duration := NUMBER UNIT {['and' | ','] NUMBER UNIT}
+#   day      := 'today' | 'tomorrow' | ['next' | 'this'] WEEKDAY | DATE
+#   clock    := NUMBER [':' NUMBER] ['am' | 'pm'] | 'noon' | 'midnight'
+
+# The input is split by one compiled scanner; the grammar above then runs
+# over its tokens with a single token of lookahead.
+SCANNER = re.compile(r'''
+    (?P<zone>[a-z]+(?:/[a-z0-9_+-]+)+|utc\b)
+  | (?P<date>\d{4}-\d{1,2}-\d{1,2})
+  | (?P<number>\d+(?:\.\d+)?|\.\d+)
+  | (?P<word>[a-z]+)
+  | (?P<colon>:)
+  | (?P<comma>,)
+  | (?P<space>\s+)
+  | (?P<error>.)
+''', re.VERBOSE | re.IGNORECASE)
+
+# The forms most imports are made of (seconds, a date with or without a
+# clock time, a clock time) are matched whole and planned without the
+# scanner; anything else, including any of these the grammar would reject,
+# is left to it.
+PLAIN = re.compile(r'''
+    (?P<seconds>\d+(?:\.\d+)?)
+  | (?:(?P<year>\d{4})-(?P<month>\d{1,2})-(?P<day>\d{1,2})(?!\d)\s*(?:t\s*)?)?
+    (?:(?P<hour>\d{1,2}):(?P<minute>\d{1,2}))?
+''', re.VERBOSE | re.IGNORECASE)
+
+UNITS = {}
+for _seconds, _names in (
+    (1, 's sec secs second seconds'),
+    (60, 'm min mins minute minutes'),
+    (3600, 'h hr hrs hour hours'),
+    (86400, 'd day days'),
+    (604800, 'w wk wks week weeks'),
+):
+    UNITS.update(dict.fromkeys(_names.split(), _seconds))
+
+WEEKDAYS = {}
+for _day, _names in enumerate((
+    'mon monday', 'tue tues tuesday', 'wed wednesday', 'thu thur thurs thursday',
+    'fri friday', 'sat saturday', 'sun sunday',
+)):
+    WEEKDAYS.update(dict.fromkeys(_names.split(), _day))
+
+# Clock time for expressions that only name a day, e.g. "tomorrow".
+DEFAULT_CLOCK = 9 * 3600
+
+
+class TimeParseError(ValueError):
+    pass
+
+
+def tokenize(text):
+    tokens = []
+    for match in SCANNER.finditer(text):
+        kind = match.lastgroup
+        if kind == 'space':
+            continue
+        if kind == 'error':
+            raise TimeParseError(f'unexpected {match.group()!r} in {text!r}')
+        # Zone names keep their case for the error message; find_zone
+        # matches them case-insensitively.
+        value = match.group()
+        if kind != 'zone':
+            value = value.lower()
+        tokens.append((kind, value))
+    # Twice, so the parser can look one past the end.
+    tokens += [('end', ''), ('end', '')]
+    return tokens
+
+
+class _Parser:
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self, offset=0):
+        return self.tokens[self.pos + offset]
+
+    def take(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def accept(self, kind, value=None):
+        token = self.peek()
+        if token[0] == kind and (value is None or token[1] == value):
+            self.pos += 1
+            return token
+        return None
+
+    def fail(self, expected):
+        kind, value = self.peek()
+        found = 'the end' if kind == 'end' else repr(value)
+        return TimeParseError(f'expected {expected} but found {found} in {self.text!r}')
+
+    def expect_end(self):
+        # Returns the zone the expression ends with, if any.
+        zone = self.accept('zone')
+        if zone is not None:
+            try:
+                zone = find_zone(zone[1])
+            except ValueError as e:
+                raise TimeParseError(f'{e} in {self.text!r}') from None
+        if self.peek()[0] != 'end':
+            raise self.fail('the end')
+        return zone
+
+    def parse(self):
+        # Returns a plan (when, every, zone). `when` is ('offset', seconds)
+        # or ('local', day, clock), where day is None, ('days', n),
+        # ('weekday', n, strictly_after_today) or ('date', y, m, d) and clock
+        # is seconds after midnight or None; `every` is the repeat interval
+        # in seconds or None.
+        kind, value = self.peek()
+        if kind == 'number' and self.peek(1)[0] in ('end', 'zone'):
+            when = ('offset', float(self.take()[1]))
+            return when, None, self.expect_end()
+        if self.accept('word', 'now'):
+            return ('offset', 0.0), None, self.expect_end()
+        if self.accept('word', 'every'):
+            return self.repeat()
+        if self.accept('word', 'in') or (kind == 'number' and self.peek(1)[1] in UNITS):
+            seconds = self.duration()
+            if self.accept('word', 'from'):
+                if not self.accept('word', 'now'):
+                    raise self.fail("'now'")
+            else:
+                self.accept('word', 'later')
+            return ('offset', seconds), None, self.expect_end()
+        day = self.day()
+        self.accept('word', 'at')
+        clock = self.clock()
+        if day is None and clock is None:
+            raise self.fail('a time')
+        return ('local', day, clock), None, self.expect_end()
+
+    def repeat(self):
+        kind, value = self.peek()
+        day = None
+        if kind == 'number':
+            every = self.duration()
+        elif value in UNITS:
+            self.take()
+            every = float(UNITS[value])
+        elif value in WEEKDAYS:
+            self.take()
+            every = float(UNITS['week'])
+            day = ('weekday', WEEKDAYS[value], False)
+        else:
+            raise self.fail('an interval or a weekday')
+        if every <= 0:
+            raise TimeParseError(f'the interval has to be positive in {self.text!r}')
+        self.accept('word', 'at')
+        clock = self.clock()
+        if day is None and clock is None:
+            # "every 2 hours": the first one is one interval from now.
+            return ('offset', every), every, self.expect_end()
+        return ('local', day, clock), every, self.expect_end()
+
+    def duration(self):
+        seconds = 0.0
+        while True:
+            number = self.accept('number')
+            if number is None:
+                raise self.fail('a number')
+            unit = self.take()
+            if unit[1] not in UNITS:
+                self.pos -= 1
+                raise self.fail('a unit such as minutes')
+            seconds += float(number[1]) * UNITS[unit[1]]
+            if self.accept('word', 'and') or self.accept('comma'):
+                continue
+            if self.peek()[0] != 'number':
+                return seconds
+
+    def day(self):
+        kind, value = self.peek()
+        if kind == 'date':
+            self.take()
+            year, month, day = map(int, value.split('-'))
+            try:
+                datetime.date(year, month, day)
+            except ValueError as e:
+                raise TimeParseError(f'{e} in {self.text!r}') from None
+            # "2026-10-20T14:30" scans as date, word 't', number...
+            if self.peek() == ('word', 't'):
+                self.take()
+            return ('date', year, month, day)
+        if kind != 'word':
+            return None
+        if value == 'today':
+            self.take()
+            return ('days', 0)
+        if value == 'tomorrow':
+            self.take()
+            return ('days', 1)
+        strict = value == 'next'
+        if value in ('next', 'this'):
+            self.take()
+            value = self.peek()[1]
+            if value not in WEEKDAYS:
+                raise self.fail('a weekday')
+        if value in WEEKDAYS:
+            self.take()
+            return ('weekday', WEEKDAYS[value], strict)
+        return None
+
+    def clock(self):
+        if self.accept('word', 'noon'):
+            return 12 * 3600
+        if self.accept('word', 'midnight'):
+            return 0
+        number = self.accept('number')
+        if number is None:
+            return None
+        if not number[1].isdigit():
+            raise TimeParseError(f'bad hour {number[1]!r} in {self.text!r}')
+        hour, minute = int(number[1]), 0
+        if self.accept('colon'):
+            minute_token = self.accept('number')
+            if minute_token is None or not minute_token[1].isdigit():
+                raise self.fail('minutes')
+            minute = int(minute_token[1])
+        if self.accept('word', 'pm'):
+            if not 1 <= hour <= 12:
+                raise TimeParseError(f'bad hour {hour} in {self.text!r}')
+            hour = hour % 12 + 12
+        elif self.accept('word', 'am'):
+            if not 1 <= hour <= 12:
+                raise TimeParseError(f'bad hour {hour} in {self.text!r}')
+            hour %= 12
+        if hour > 23 or minute > 59:
+            raise TimeParseError(f'bad time {hour}:{minute:02d} in {self.text!r}')
+        return hour * 3600 + minute * 60
+
+
+def _plain_plan(text):
+    match = PLAIN.fullmatch(text)
+    if match is None:
+        return None
+    seconds, year, month, day, hour, minute = match.groups()
+    if seconds is not None:
+        return ('offset', float(seconds)), None, None
+    clock = None
+    if hour is not None:
+        hour, minute = int(hour), int(minute)
+        if hour > 23 or minute > 59:
+            return None
+        clock = hour * 3600 + minute * 60
+    if year is None:
+        return None if clock is None else (('local', None, clock), None, None)
+    year, month, day = int(year), int(month), int(day)
+    try:
+        datetime.date(year, month, day)
+    except ValueError:
+        return None
+    return ('local', ('date', year, month, day), clock), None, None
+
+
+def compile_expression(text):
+    # Plans don't depend on the current time, so repeated expressions are
+    # only parsed once. The plain forms are cheaper to plan again than to
+    # look up, and would only push the others out of the cache.
+    text = text.strip()
+    return _plain_plan(text) or _parse(text)
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse(text):
+    return _Parser(text).parse()
+
+
+def _finite(text):
+    # A plain number as given, which JSON and float() both allow to be NaN
+    # or infinite.
+    value = float(text)
+    if not math.isfinite(value):
+        raise TimeParseError(f'expected a finite number, not {text!r}')
+    return value
+
+
+def _compiled(text):
+    # compile_expression for what came in as JSON or from a caller, which
+    # may not be a string at all.
+    if not isinstance(text, str):
+        raise TimeParseError(f'expected seconds or a time expression, not {text!r}')
+    return compile_expression(text)
+
+
+class _Evaluator:
+    # Turns plans into schedules for one fixed `now`. Each zone's local date
+    # and the result for each (plan, zone) are worked out once.
+
+    def __init__(self, now):
+        self.now = now
+        self._today = {}
+        self._results = {}
+
+    def __call__(self, plan, zone=None):
+        when, every, own_zone = plan
+        zone = own_zone or zone
+        if when[0] == 'offset':
+            return self.now + when[1], every, zone
+        key = (when, zone)
+        due = self._results.get(key)
+        if due is None:
+            due = self._results[key] = self._local(when[1], when[2], zone)
+        return due, every, zone
+
+    def today(self, zone):
+        today = self._today.get(zone)
+        if today is None:
+            if zone is None:
+                today = datetime.date.fromtimestamp(self.now)
+            else:
+                today = zone_table(zone).today(self.now)
+            self._today[zone] = today
+        return today
+
+    def _at(self, date, clock, zone):
+        return local_to_utc(date, clock, zone)
+
+    def _local(self, day, clock, zone):
+        if day is not None and day[0] == 'date':
+            # The only form that doesn't depend on today.
+            return self._at(datetime.date(*day[1:]), DEFAULT_CLOCK if clock is None else clock, zone)
+        one_day = datetime.timedelta(days=1)
+        today = self.today(zone)
+        if day is None:
+            # A bare clock time means the next time it comes around.
+            when = self._at(today, clock, zone)
+            return when if when > self.now else self._at(today + one_day, clock, zone)
+        if clock is None:
+            clock = DEFAULT_CLOCK
+        if day[0] == 'days':
+            return self._at(today + day[1] * one_day, clock, zone)
+        _, weekday, strict = day
+        ahead = (weekday - today.weekday()) % 7
+        if ahead == 0 and (strict or self._at(today, clock, zone) <= self.now):
+            ahead = 7
+        return self._at(today + ahead * one_day, clock, zone)
+
+
+def parse_schedule(text, now=None, zone=None):
+    # (due, every, zone) for an expression: the first due time as a unix
+    # timestamp, the repeat interval in seconds (None for one-shot times)
+    # and the IANA zone it was read in (None for the system's local time).
+    # `zone` applies unless the expression names its own. Plain numbers
+    # (int, float or a numeric string) are seconds from now, as the menu
+    # always took.
+    now = time.time() if now is None else now
+    zone = find_zone(zone) if zone else None
+    if isinstance(text, (int, float)):
+        return now + _finite(text), None, zone
+    return _Evaluator(now)(_compiled(text), zone)
+
+
+def parse_duration(text):
+    # Seconds for '10 minutes', '1h30m', or a plain number of seconds.
+    if isinstance(text, (int, float)):
+        return _finite(text)
+    when, every, zone = _compiled(text)
+    if when[0] != 'offset' or every is not None or zone is not None:
+        raise TimeParseError(f'expected a duration such as 10 minutes, not {text!r}')
+    return when[1]
+
+
+def parse_time(text, now=None, zone=None):
+    return parse_schedule(text, now, zone)[0]
+
+
+def parse_instant(text, now=None, zone=None):
+    # A point in time where a unix timestamp used to be expected: plain
+    # numbers still are one, anything else is read as an expression.
+    try:
+        value = float(text)
+    except (TypeError, ValueError):
+        return parse_time(text, now, zone)
+    return _finite(value)
+
+
+def parse_schedules(texts, now=None, zones=None):
+    # Bulk form for imports: one `now` and one evaluator for the batch;
+    # `zones`, if given, runs parallel to `texts`.
+    now = time.time() if now is None else now
+    evaluate = _Evaluator(now)
+    zones = zones if zones is not None else [None] * len(texts)
+    results = []
+    for text, zone in zip(texts, zones):
+        zone = find_zone(zone) if zone else None
+        if isinstance(text, (int, float)):
+            results.append((now + _finite(text), None, zone))
+        else:
+            results.append(evaluate(_compiled(text), zone))
+    return results
@@ -0,0 +1,104 @@
+import datetime
+import functools
+import zoneinfo
+from bisect import bisect_right
+
+# Transitions are looked for in this range; outside it the first or last
+# offset applies.
+TABLE_START = 0  # 1970-01-01
+TABLE_END = 4102444800  # 2100-01-01
+# Offsets are sampled this far apart and each change is then narrowed down
+# to the second, so two transitions closer together than this are missed.
+SAMPLE_STEP = 7 * 86400
+
+UTC = datetime.timezone.utc
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def wall_seconds(date, clock=0):
+    # A wall-clock time as seconds since 1970-01-01 00:00 on that wall clock.
+    return (date.toordinal() - EPOCH_ORDINAL) * 86400 + clock
+
+
+def local_to_utc(date, clock, zone=None):
+    # Unix time of a wall-clock time in an IANA zone, or in the system's
+    # local time when zone is None.
+    if zone is not None:
+        return float(zone_table(zone).to_utc(wall_seconds(date, clock)))
+    hours, seconds = divmod(clock, 3600)
+    return datetime.datetime(date.year, date.month, date.day, hours, seconds // 60).timestamp()
+
+
+class ZoneTable:
+    # UTC offsets of one IANA zone as a sorted transition table, so
+    # converting either way is a bisect instead of tz arithmetic.
+
+    def __init__(self, name):
+        self.name = name
+        try:
+            zone = zoneinfo.ZoneInfo(name)
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            raise ValueError(f'unknown time zone {name!r}') from None
+
+        def offset(t):
+            return int(datetime.datetime.fromtimestamp(t, zone).utcoffset().total_seconds())
+
+        # offsets[i] applies from utc[i] (inclusive) to utc[i + 1].
+        self.utc = [float('-inf')]
+        self.offsets = [offset(TABLE_START)]
+        t = TABLE_START
+        while t < TABLE_END:
+            nxt = min(t + SAMPLE_STEP, TABLE_END)
+            current = self.offsets[-1]
+            if offset(nxt) != current:
+                lo, hi = t, nxt
+                while hi - lo > 1:
+                    mid = (lo + hi) // 2
+                    if offset(mid) == current:
+                        lo = mid
+                    else:
+                        hi = mid
+                self.utc.append(hi)
+                self.offsets.append(offset(hi))
+                t = hi
+            else:
+                t = nxt
+        # The wall-clock time at which each offset starts to apply.
+        self.wall = [start + off for start, off in zip(self.utc, self.offsets)]
+
+    def utcoffset(self, t):
+        return self.offsets[bisect_right(self.utc, t) - 1]
+
+    def to_wall(self, t):
+        return t + self.utcoffset(t)
+
+    def to_utc(self, wall):
+        # Wall times that occur twice (clocks going back) give the first
+        # one; skipped ones (clocks going forward) are pushed past the gap
+        # by its length, as datetime does with fold=0.
+        i = bisect_right(self.wall, wall) - 1
+        if i >= 1 and wall - self.offsets[i - 1] < self.utc[i]:
+            i -= 1
+        return wall - self.offsets[i]
+
+    def today(self, now):
+        return datetime.date.fromordinal(int(self.to_wall(now) // 86400) + EPOCH_ORDINAL)
+
+
+@functools.lru_cache(maxsize=None)
+def zone_table(name):
+    return ZoneTable(name)
+
+
+@functools.lru_cache(maxsize=None)
+def _zone_names():
+    return {name.lower(): name for name in zoneinfo.available_timezones()}
+
+
+def find_zone(name):
+    # The IANA name for `name`, matched case-insensitively.
+    if not isinstance(name, str):
+        raise ValueError(f'unknown time zone {name!r}')
+    canonical = _zone_names().get(name.lower(), name)
+    zone_table(canonical)
+    return canonical